@@ -0,0 +1,113 @@
+"""
+Write-behind счётчики активности (user_activity).
+
+Сообщения и реакции только увеличивают счётчики в памяти, а фоновая задача
+раз в ACTIVITY_FLUSH_INTERVAL секунд (и при остановке сервера) сбрасывает их
+в БД одним INSERT ... ON CONFLICT. /get_activity подмешивает ещё не
+сброшенные значения (и те, что сейчас пишутся, — до коммита), собирая их со
+всех воркеров через бэкплейн: свои читает вместе с БД под блокировкой сброса
+(read_with_pending), а чужие запрашивает до чтения БД.
+"""
+import asyncio
+import os
+from datetime import datetime
+
+from sqlalchemy import text
+
+from database import AsyncSessionLocal
+
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "10"))
+
+FLUSH_SQL = """
+    INSERT INTO user_activity (username, date, messages_count, reactions_given, reactions_received)
+    SELECT * FROM unnest(CAST(:u AS text[]), CAST(:d AS text[]), CAST(:m AS int[]), CAST(:g AS int[]), CAST(:r AS int[]))
+    ON CONFLICT (username, date) DO UPDATE SET
+        messages_count = user_activity.messages_count + EXCLUDED.messages_count,
+        reactions_given = user_activity.reactions_given + EXCLUDED.reactions_given,
+        reactions_received = user_activity.reactions_received + EXCLUDED.reactions_received
+"""
+
+
+class ActivityAggregator:
+    def __init__(self, interval: float = ACTIVITY_FLUSH_INTERVAL):
+        self.interval = interval
+        # (username, date) -> [messages, reactions_given, reactions_received]
+        self.pending: dict[tuple[str, str], list[int]] = {}
+        # Пачка, которая сейчас пишется в БД: видна в pending_for, пока не закоммичена
+        self.flushing: dict[tuple[str, str], list[int]] = {}
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task = None
+
+    def record(self, username: str, messages: int = 0, reactions_given: int = 0, reactions_received: int = 0):
+        key = (username, datetime.now().strftime("%Y-%m-%d"))
+        counters = self.pending.setdefault(key, [0, 0, 0])
+        counters[0] += messages
+        counters[1] += reactions_given
+        counters[2] += reactions_received
+
+    def pending_for(self, username: str) -> dict[str, list[int]]:
+        result = {}
+        for source in (self.flushing, self.pending):
+            for (user, date), counters in source.items():
+                if user == username:
+                    merged = result.setdefault(date, [0, 0, 0])
+                    for i in range(3):
+                        merged[i] += counters[i]
+        return result
+
+    async def read_with_pending(self, username: str, read):
+        """
+        await read() и pending_for(username) под блокировкой сброса: пачка не может
+        закоммититься между ними, так что она попадёт ровно в одно из двух.
+        """
+        async with self._lock:
+            return await read(), self.pending_for(username)
+
+    async def flush(self):
+        async with self._lock:
+            if self.pending:
+                await self._flush()
+
+    async def _flush(self):
+        batch, self.pending = self.pending, {}
+        self.flushing = batch
+        keys = list(batch)
+        params = {
+            "u": [k[0] for k in keys],
+            "d": [k[1] for k in keys],
+            "m": [batch[k][0] for k in keys],
+            "g": [batch[k][1] for k in keys],
+            "r": [batch[k][2] for k in keys],
+        }
+        try:
+            async with AsyncSessionLocal() as session:
+                await session.execute(text(FLUSH_SQL), params)
+                await session.commit()
+                # Сразу после коммита: дальше эти счётчики уже читаются из БД
+                self.flushing = {}
+        except Exception as e:
+            # Не теряем счётчики: возвращаем их обратно, попробуем в следующий раз
+            print(f"Activity flush error: {e}")
+            for key, counters in batch.items():
+                merged = self.pending.setdefault(key, [0, 0, 0])
+                for i in range(3):
+                    merged[i] += counters[i]
+        finally:
+            self.flushing = {}
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self.flush()
+
+
+activity = ActivityAggregator()
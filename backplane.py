@@ -0,0 +1,159 @@
+"""
+Шина событий между воркерами для ConnectionManager.
+
+Каждый воркер доставляет событие своим сокетам сам, а через бэкплейн
+рассылает его остальным воркерам. Реализации:
+  - InMemoryBackplane — по умолчанию, в пределах одного процесса;
+  - PostgresBackplane — LISTEN/NOTIFY в той же базе (BACKPLANE=postgres),
+    так что для нескольких воркеров/нод не нужен отдельный сервис.
+"""
+import abc
+import asyncio
+import json
+import os
+import socket
+import uuid
+
+import asyncpg
+
+from database import DATABASE_URL
+
+BACKPLANE = os.getenv("BACKPLANE", "memory")
+NOTIFY_CHANNEL = "flux_events"
+# Лимит NOTIFY — 8000 байт; всё, что больше, кладём в таблицу и шлём только id
+NOTIFY_MAX_BYTES = 7500
+EVENT_RETENTION_SECONDS = 300
+
+
+def new_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class Backplane(abc.ABC):
+    # True — другие воркеры в других процессах, и их ответы приходят не сразу
+    remote = False
+
+    def __init__(self):
+        self.worker_id = new_worker_id()
+        self._handler = None
+
+    async def start(self, handler):
+        """handler(event) вызывается для событий от других воркеров."""
+        self._handler = handler
+
+    @abc.abstractmethod
+    async def publish(self, event: dict):
+        """Рассылает событие остальным воркерам (с полем worker = свой worker_id)."""
+
+    async def stop(self):
+        pass
+
+    async def _dispatch(self, event: dict):
+        if event.get("worker") == self.worker_id or self._handler is None:
+            return
+        try:
+            await self._handler(event)
+        except Exception as e:
+            print(f"Backplane handler error: {e}")
+
+
+class InMemoryBackplane(Backplane):
+    """Все бэкплейны одного процесса видят события друг друга (удобно и для проверок)."""
+    _peers: list = []
+
+    async def start(self, handler):
+        await super().start(handler)
+        InMemoryBackplane._peers.append(self)
+
+    async def publish(self, event: dict):
+        event = {**event, "worker": self.worker_id}
+        for peer in list(InMemoryBackplane._peers):
+            if peer is not self:
+                await peer._dispatch(event)
+
+    async def stop(self):
+        if self in InMemoryBackplane._peers:
+            InMemoryBackplane._peers.remove(self)
+
+
+class PostgresBackplane(Backplane):
+    remote = True
+
+    def __init__(self, dsn: str = None):
+        super().__init__()
+        # asyncpg понимает обычный postgresql:// без драйвера SQLAlchemy
+        self.dsn = dsn or DATABASE_URL.replace("postgresql+asyncpg://", "postgresql://", 1)
+        self._listen_conn = None
+        self._pool = None
+        self._watchdog: asyncio.Task = None
+        self._consumer: asyncio.Task = None
+        # Уведомления разбираем по одному, чтобы события не обгоняли друг друга
+        self._inbox: asyncio.Queue = asyncio.Queue()
+
+    async def start(self, handler):
+        await super().start(handler)
+        self._pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=4)
+        await self._listen()
+        self._consumer = asyncio.create_task(self._consume())
+        self._watchdog = asyncio.create_task(self._watch())
+
+    async def _listen(self):
+        self._listen_conn = await asyncpg.connect(self.dsn)
+        await self._listen_conn.add_listener(NOTIFY_CHANNEL, self._on_notify)
+
+    async def _watch(self):
+        # Переподключаемся, если LISTEN-соединение отвалилось, и чистим старые большие события
+        while True:
+            await asyncio.sleep(5)
+            try:
+                if self._listen_conn is None or self._listen_conn.is_closed():
+                    await self._listen()
+                await self._pool.execute(
+                    "DELETE FROM backplane_events WHERE created_at < now() - make_interval(secs => $1)",
+                    EVENT_RETENTION_SECONDS,
+                )
+            except Exception as e:
+                print(f"Backplane watchdog error: {e}")
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self._inbox.put_nowait(payload)
+
+    async def _consume(self):
+        while True:
+            payload = await self._inbox.get()
+            try:
+                event = json.loads(payload)
+                if event.get("worker") == self.worker_id:
+                    continue
+                if "ref" in event:
+                    stored = await self._pool.fetchval("SELECT payload FROM backplane_events WHERE id=$1", event["ref"])
+                    if stored is None:
+                        continue
+                    event = json.loads(stored)
+                await self._dispatch(event)
+            except Exception as e:
+                print(f"Backplane receive error: {e}")
+
+    async def publish(self, event: dict):
+        payload = json.dumps({**event, "worker": self.worker_id})
+        if len(payload.encode()) > NOTIFY_MAX_BYTES:
+            ref = await self._pool.fetchval("INSERT INTO backplane_events (payload) VALUES ($1) RETURNING id", payload)
+            payload = json.dumps({"ref": ref, "worker": self.worker_id})
+        await self._pool.execute("SELECT pg_notify($1, $2)", NOTIFY_CHANNEL, payload)
+
+    async def stop(self):
+        for task in (self._watchdog, self._consumer):
+            if task:
+                task.cancel()
+        if self._listen_conn and not self._listen_conn.is_closed():
+            await self._listen_conn.close()
+        if self._pool:
+            await self._pool.close()
+
+
+def create_backplane(kind: str = BACKPLANE) -> Backplane:
+    if kind == "postgres":
+        return PostgresBackplane()
+    if kind == "memory":
+        return InMemoryBackplane()
+    raise ValueError(f"unknown backplane: {kind}")
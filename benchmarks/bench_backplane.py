@@ -0,0 +1,104 @@
+"""
+Проверка доставки через бэкплейн между несколькими воркерами.
+
+Запуск (нужна тестовая база из DATABASE_URL):
+    python benchmarks/bench_backplane.py
+Скрипт поднимает WORKERS процессов uvicorn с BACKPLANE=postgres на разных
+портах, подключает по клиенту к каждому и проверяет, что:
+  - клиент на одном воркере видит онлайн-статус (кадр presence) контакта с другого;
+  - личные события (call_offer) доходят до сокета на другом воркере;
+и меряет задержку такой доставки.
+"""
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import websockets
+from sqlalchemy import text
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKERS = int(os.getenv("WORKERS", "3"))
+BASE_PORT = int(os.getenv("BASE_PORT", "8101"))
+ROUNDS = 200
+sys.path.insert(0, ROOT)
+
+
+def start_workers() -> list:
+    env = {**os.environ, "BACKPLANE": "postgres"}
+    return [
+        subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(BASE_PORT + i), "--log-level", "warning"], cwd=ROOT, env=env)
+        for i in range(WORKERS)
+    ]
+
+
+async def connect(port: int, username: str):
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            ws = await websockets.connect(f"ws://127.0.0.1:{port}/ws/{username}")
+            await ws.recv()  # initial_status
+            return ws
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.5)
+
+
+async def wait_for(ws, predicate, timeout: float = 5):
+    async def loop():
+        while True:
+            data = json.loads(await ws.recv())
+            if isinstance(data, dict) and predicate(data):
+                return data
+    return await asyncio.wait_for(loop(), timeout)
+
+
+async def make_contacts(last: str, others: list[str]):
+    # Статусы видят только контакты: заводим лички последнего клиента с остальными
+    from database import AsyncSessionLocal, engine
+    async with AsyncSessionLocal() as session:
+        for other in others:
+            u1, u2 = sorted([last, other])
+            await session.execute(text("INSERT INTO dms (user1, user2) VALUES (:a, :b) ON CONFLICT DO NOTHING"), {"a": u1, "b": u2})
+        await session.commit()
+    await engine.dispose()
+
+
+async def main():
+    names = [f"bench_bp_{i}" for i in range(WORKERS)]
+    last = names[-1]
+    procs = start_workers()
+    try:
+        # Воркеры сами прогоняют миграции, поэтому лички заводим после их старта
+        clients = [await connect(BASE_PORT + i, name) for i, name in enumerate(names[:-1])]
+        await make_contacts(last, names[:-1])
+        clients.append(await connect(BASE_PORT + WORKERS - 1, last))
+        # Каждый клиент должен получить кадр presence, где последний подключившийся — online
+        for ws in clients[:-1]:
+            await wait_for(ws, lambda d: d.get("type") == "presence" and last in d.get("online", []))
+        print(f"presence: {WORKERS - 1} remote workers saw {last} online")
+
+        sender, receiver = clients[0], clients[-1]
+        latencies = []
+        for i in range(ROUNDS):
+            started = time.perf_counter()
+            await sender.send(json.dumps({"type": "call_offer", "target": last, "seq": i}))
+            await wait_for(receiver, lambda d: d.get("type") == "call_offer" and d.get("seq") == i)
+            latencies.append((time.perf_counter() - started) * 1000)
+        latencies.sort()
+        print(f"cross-worker personal delivery x{ROUNDS}: p50 {latencies[len(latencies) // 2]:.2f} ms, p99 {latencies[int(len(latencies) * 0.99)]:.2f} ms")
+
+        for ws in clients:
+            await ws.close()
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
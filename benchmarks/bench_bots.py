@@ -0,0 +1,100 @@
+"""
+Проверка команд бота против локальной заглушки внешних API.
+
+Запуск (база и сеть не нужны):
+    python benchmarks/bench_bots.py
+Скрипт поднимает на 127.0.0.1 заглушку Giphy и wttr.in, направляет на неё
+bots.py через BOT_*_URL и проверяет, что:
+  - одновременные /weather для одного города дают один запрос наружу,
+    а повтор берётся из кэша;
+  - одновременных запросов наружу не больше лимита команды;
+  - зависший API укладывается в таймаут и отвечает текстом ошибки;
+  - /gif, /joke и /help отвечают.
+"""
+import asyncio
+import os
+import sys
+import time
+
+from aiohttp import web
+
+PORT = int(os.getenv("STUB_PORT", "8199"))
+UPSTREAM_DELAY = 0.2
+os.environ.setdefault("BOT_GIPHY_URL", f"http://127.0.0.1:{PORT}/gif")
+os.environ.setdefault("BOT_WEATHER_URL", f"http://127.0.0.1:{PORT}/weather")
+os.environ.setdefault("BOT_TIMEOUT", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bots
+
+hits = {"weather": 0, "active": 0, "max_active": 0}
+
+
+async def stub_weather(request):
+    city = request.match_info["city"]
+    hits["weather"] += 1
+    hits["active"] += 1
+    hits["max_active"] = max(hits["max_active"], hits["active"])
+    try:
+        # «hang» изображает зависший API
+        await asyncio.sleep(5 if city == "hang" else UPSTREAM_DELAY)
+        return web.Response(text=f"{city}: ☀️ +20°C\n")
+    finally:
+        hits["active"] -= 1
+
+
+async def stub_gif(request):
+    tag = request.query.get("tag", "")
+    return web.json_response({"data": {"images": {"original": {"url": f"https://example.com/{tag}.gif"}}}})
+
+
+async def start_stub():
+    app = web.Application()
+    app.router.add_get("/weather/{city}", stub_weather)
+    app.router.add_get("/gif", stub_gif)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+    return runner
+
+
+async def run(content: str) -> str:
+    cmd, args = bots.parse(content)
+    return await bots.execute(cmd, args)
+
+
+async def main():
+    runner = await start_stub()
+    try:
+        started = time.perf_counter()
+        replies = await asyncio.gather(*(run("/weather Москва") for _ in range(50)))
+        print(f"50 x /weather Москва: {time.perf_counter() - started:.2f} s, upstream calls {hits['weather']}")
+        assert hits["weather"] == 1 and len(set(replies)) == 1, replies[:3]
+
+        started = time.perf_counter()
+        await run("/weather москва")
+        print(f"repeat (cached): {(time.perf_counter() - started) * 1000:.2f} ms, upstream calls {hits['weather']}")
+        assert hits["weather"] == 1
+
+        limit = bots.commands["/weather"].concurrency
+        started = time.perf_counter()
+        await asyncio.gather(*(run(f"/weather city{i}") for i in range(limit * 2)))
+        print(f"{limit * 2} cities: {time.perf_counter() - started:.2f} s, max concurrent upstream {hits['max_active']} (limit {limit})")
+        assert hits["max_active"] <= limit
+
+        started = time.perf_counter()
+        reply = await run("/weather hang")
+        elapsed = time.perf_counter() - started
+        print(f"hung upstream: {elapsed:.2f} s (timeout {bots.BOT_TIMEOUT}) -> {reply!r}")
+        assert elapsed < bots.BOT_TIMEOUT + 0.5 and reply.startswith("❌")
+
+        for content in ("/gif cats", "/joke", "/help"):
+            print(f"{content}: {(await run(content)).splitlines()[0]}")
+        print(bots.stats())
+    finally:
+        await bots.stop()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
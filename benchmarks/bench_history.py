@@ -0,0 +1,81 @@
+"""
+Бенчмарк загрузки истории: старый N+1 цикл против load_history.
+
+Запуск (нужна тестовая база из DATABASE_URL):
+    python benchmarks/bench_history.py
+Скрипт создаёт временный канал с 50 сообщениями (половина — ответы),
+меряет число запросов к БД и время на одну страницу, потом удаляет данные.
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event, text
+from database import AsyncSessionLocal, engine, init_db
+from main import load_history
+
+CHANNEL = "bench_history_channel"
+ROUNDS = 20
+queries = 0
+
+
+def count_query(*args, **kwargs):
+    global queries
+    queries += 1
+
+
+async def legacy_history(session, channel):
+    # Копия старого обработчика: по запросу на превью ответа и на user_id автора
+    res = await session.execute(text("SELECT m.id, m.username, m.content, m.channel, m.created_at, u.avatar_url, u.bio, u.is_admin, m.is_edited, m.reactions, m.reply_to, m.read_by, m.timer, m.viewed_at, m.mentions, m.forwarded_from, m.is_pinned, m.link_preview FROM messages m LEFT JOIN users u ON m.username = u.username WHERE m.channel=:ch ORDER BY m.id DESC LIMIT 50"), {"ch": channel})
+    history = []
+    for r in res.fetchall():
+        reply_content = None
+        if r[10]:
+            parent = (await session.execute(text("SELECT username, content FROM messages WHERE id=:pid"), {"pid": r[10]})).fetchone()
+            if parent: reply_content = {"username": parent[0], "content": parent[1]}
+        user_id_row = (await session.execute(text("SELECT user_id FROM users WHERE username=:u"), {"u": r[1]})).fetchone()
+        history.append({"id": r[0], "reply_preview": reply_content, "user_id": user_id_row[0] if user_id_row else None, "reactions": json.loads(r[9]) if r[9] else {}})
+    return history
+
+
+async def seed():
+    async with AsyncSessionLocal() as session:
+        await session.execute(text("DELETE FROM messages WHERE channel=:ch"), {"ch": CHANNEL})
+        prev = None
+        for i in range(50):
+            prev = (await session.execute(text("INSERT INTO messages (username, content, channel, created_at, reply_to) VALUES (:u, :c, :ch, '00:00', :rep) RETURNING id"), {"u": f"bench_user_{i % 5}", "c": f"message {i}", "ch": CHANNEL, "rep": prev if i % 2 else None})).scalar()
+        await session.commit()
+
+
+async def measure(name, loader):
+    global queries
+    async with AsyncSessionLocal() as session:
+        await loader(session, CHANNEL)  # прогрев
+        queries = 0
+        started = time.perf_counter()
+        for _ in range(ROUNDS):
+            page = await loader(session, CHANNEL)
+        elapsed = (time.perf_counter() - started) / ROUNDS
+    print(f"{name:>8}: {len(page)} rows, {queries / ROUNDS:.0f} round trips, {elapsed * 1000:.2f} ms/page")
+
+
+async def main():
+    await init_db()
+    event.listen(engine.sync_engine, "before_cursor_execute", count_query)
+    await seed()
+    try:
+        await measure("before", legacy_history)
+        await measure("after", load_history)
+    finally:
+        async with AsyncSessionLocal() as session:
+            await session.execute(text("DELETE FROM messages WHERE channel=:ch"), {"ch": CHANNEL})
+            await session.commit()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,68 @@
+"""
+Бенчмарк всплеска логинов: Argon2 прямо в цикле событий против passwords.py.
+
+Запуск (база не нужна):
+    python benchmarks/bench_login.py
+Параллельно с CONCURRENT проверками пароля крутится «пульс» цикла событий
+раз в 10 мс. Для каждого варианта печатаем общее время, пропускную
+способность и максимальную задержку пульса — столько же ждали бы все
+websocket'ы. Отдельно видно, сколько запросов отбито как 503 (HashingBusy).
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import passwords
+
+CONCURRENT = int(os.getenv("CONCURRENT", "50"))
+TICK = 0.01
+
+
+async def heartbeat(stop: asyncio.Event, lags: list):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - started - TICK)
+
+
+async def inline_verify(plain, hashed):
+    # Как было: синхронный passlib внутри async-обработчика
+    return passwords.pwd_context.verify(plain, hashed)
+
+
+async def pooled_verify(plain, hashed):
+    try:
+        ok, _ = await passwords.verify_password(plain, hashed)
+        return ok
+    except passwords.HashingBusy:
+        return None
+
+
+async def run(name, verify, hashed):
+    stop, lags = asyncio.Event(), []
+    ticker = asyncio.create_task(heartbeat(stop, lags))
+    await asyncio.sleep(TICK * 2)
+    started = time.perf_counter()
+    results = await asyncio.gather(*(verify("secret-password", hashed) for _ in range(CONCURRENT)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await ticker
+    rejected = sum(1 for r in results if r is None)
+    print(
+        f"{name:>8}: {elapsed:.2f} s total, {(CONCURRENT - rejected) / elapsed:.1f} logins/s, "
+        f"max loop stall {max(lags) * 1000:.1f} ms, rejected {rejected}"
+    )
+
+
+async def main():
+    hashed = passwords.pwd_context.hash("secret-password")
+    print(f"{CONCURRENT} concurrent logins, {passwords.HASH_WORKERS} hash workers, queue limit {passwords.HASH_QUEUE_LIMIT}")
+    await run("inline", inline_verify, hashed)
+    await run("executor", pooled_verify, hashed)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,85 @@
+"""
+Бенчмарк поиска: старый `content LIKE '%q%'` против tsvector + GIN.
+
+Запуск (нужна тестовая база из DATABASE_URL, займёт несколько минут):
+    python benchmarks/bench_search.py [rows] [--keep]
+По умолчанию генерирует 5 000 000 сообщений в отдельной схеме flux_bench
+(копия таблицы messages со всеми индексами) и в конце её удаляет.
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+from database import AsyncSessionLocal, engine, init_db
+from search import search_messages
+
+ROWS = next((int(a) for a in sys.argv[1:] if a.isdigit()), 5_000_000)
+BATCH = 500_000
+ROUNDS = 5
+WORDS = [
+    "привет", "как", "дела", "сегодня", "завтра", "встреча", "проект", "релиз", "баг", "фича",
+    "hello", "world", "deploy", "server", "database", "index", "query", "cache", "socket", "latency",
+    "кофе", "обед", "вечер", "музыка", "фильм", "игра", "погода", "город", "работа", "отпуск",
+]
+QUERIES = ["релиз", "deploy server", "погода город", "кэш"]
+
+
+async def seed(session):
+    await session.execute(text("DROP SCHEMA IF EXISTS flux_bench CASCADE"))
+    await session.execute(text("CREATE SCHEMA flux_bench"))
+    await session.execute(text("CREATE TABLE flux_bench.messages (LIKE public.messages INCLUDING ALL)"))
+    words = "ARRAY[" + ", ".join(f"'{w}'" for w in WORDS) + "]"
+    pick = f"({words})[1 + floor(random() * {len(WORDS)})::int]"
+    for start in range(0, ROWS, BATCH):
+        await session.execute(
+            text(
+                f"""
+                INSERT INTO flux_bench.messages (username, content, channel, created_at)
+                SELECT 'user_' || (g % 1000), {pick} || ' ' || {pick} || ' ' || {pick} || ' ' || {pick},
+                       'group_' || (g % 200), '00:00'
+                FROM generate_series(:a, :b) g
+                """
+            ),
+            {"a": start + 1, "b": min(start + BATCH, ROWS)},
+        )
+        await session.commit()
+        print(f"seeded {min(start + BATCH, ROWS)} rows")
+    await session.execute(text("ANALYZE flux_bench.messages"))
+    await session.commit()
+
+
+async def timed(fn):
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        result = await fn()
+    return (time.perf_counter() - started) / ROUNDS * 1000, result
+
+
+async def main():
+    await init_db()
+    async with AsyncSessionLocal() as session:
+        await seed(session)
+        await session.execute(text("SET search_path TO flux_bench, public"))
+        channels = [f"group_{i}" for i in range(20)]
+        for q in QUERIES:
+            like_ms, rows = await timed(lambda: session.execute(
+                text("SELECT id, username, content, created_at FROM messages WHERE channel=:ch AND content LIKE :q ORDER BY id DESC"),
+                {"ch": "group_1", "q": f"%{q}%"},
+            ))
+            like_hits = len(rows.fetchall())
+            fts_ms, page = await timed(lambda: search_messages(session, q, ["group_1"]))
+            cross_ms, _ = await timed(lambda: search_messages(session, q, channels, sort="relevance"))
+            print(f"{q!r:>16}: LIKE {like_ms:8.1f} ms ({like_hits} rows) | FTS page {fts_ms:6.1f} ms ({len(page['results'])} rows) | 20 channels by rank {cross_ms:6.1f} ms")
+        await session.execute(text("SET search_path TO public"))
+        if "--keep" not in sys.argv:
+            await session.execute(text("DROP SCHEMA flux_bench CASCADE"))
+            await session.commit()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,239 @@
+"""
+Контентно-адресуемое хранилище медиа (картинки, голосовые, файлы).
+
+Файл лежит на диске под своим SHA-256, поэтому одинаковые загрузки
+хранятся один раз. В messages.content вместо base64 пишется короткая
+ссылка вида `[MEDIA:image/png]/blobs/<sha256>` или `[FILE:имя]/blobs/<sha256>`.
+
+Разовая миграция старых `data:` сообщений:
+    python blobstore.py
+"""
+import asyncio
+import base64
+import hashlib
+import os
+import re
+import tempfile
+from urllib.parse import unquote_to_bytes
+
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+from sqlalchemy import text
+
+from database import AsyncSessionLocal
+
+BLOB_DIR = os.getenv("BLOB_DIR", "blobs")
+BLOB_MAX_SIZE = int(os.getenv("BLOB_MAX_SIZE", str(50 * 1024 * 1024)))
+CHUNK_SIZE = 1024 * 1024
+MEDIA_PREFIX = "[MEDIA:"
+FILE_PREFIX = "[FILE:"
+SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class BlobTooLarge(Exception):
+    pass
+
+
+class BlobStore:
+    def __init__(self, root: str):
+        self.root = root
+        self.tmp_dir = os.path.join(root, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def path_for(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest: str) -> bool:
+        return bool(SHA256_RE.match(digest)) and os.path.exists(self.path_for(digest))
+
+    async def save_chunks(self, chunks, max_size: int = BLOB_MAX_SIZE) -> tuple[str, int]:
+        """
+        Пишет поток во временный файл, попутно считая хеш, и переносит его
+        на место только если такого блоба ещё нет.
+        """
+        sha = hashlib.sha256()
+        size = 0
+        tmp = tempfile.NamedTemporaryFile(dir=self.tmp_dir, delete=False)
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > max_size:
+                    raise BlobTooLarge(size)
+                sha.update(chunk)
+                await asyncio.to_thread(tmp.write, chunk)
+            tmp.close()
+            digest = sha.hexdigest()
+            final = self.path_for(digest)
+            if os.path.exists(final):
+                os.remove(tmp.name)
+            else:
+                os.makedirs(os.path.dirname(final), exist_ok=True)
+                os.replace(tmp.name, final)
+            return digest, size
+        except BaseException:
+            tmp.close()
+            if os.path.exists(tmp.name):
+                os.remove(tmp.name)
+            raise
+
+    async def save_bytes(self, data: bytes) -> tuple[str, int]:
+        async def one_chunk():
+            yield data
+        return await self.save_chunks(one_chunk(), max_size=max(BLOB_MAX_SIZE, len(data)))
+
+
+blob_store = BlobStore(BLOB_DIR)
+
+
+async def iter_upload(upload, chunk_size: int = CHUNK_SIZE):
+    while True:
+        chunk = await upload.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+async def register_blob(session, digest: str, size: int, mime: str):
+    await session.execute(
+        text("INSERT INTO blobs (sha256, size, mime) VALUES (:h, :s, :m) ON CONFLICT (sha256) DO NOTHING"),
+        {"h": digest, "s": size, "m": mime},
+    )
+
+
+def media_reference(digest: str, mime: str, filename: str = None) -> str:
+    url = f"/blobs/{digest}"
+    if filename:
+        return f"{FILE_PREFIX}{filename.replace(']', ')')}]{url}"
+    return f"{MEDIA_PREFIX}{mime}]{url}"
+
+
+def is_media_content(content: str) -> bool:
+    return bool(content) and content.startswith(("data:", MEDIA_PREFIX, FILE_PREFIX))
+
+
+def has_inline_data(content: str) -> bool:
+    """Медиа, присланное base64-строкой прямо в сообщении (старые клиенты)."""
+    return bool(content) and (content.startswith("data:") or (content.startswith(FILE_PREFIX) and "]data:" in content))
+
+
+def parse_data_url(value: str):
+    """`data:<mime>[;base64],<payload>` -> (mime, bytes) или None."""
+    if not value.startswith("data:") or "," not in value:
+        return None
+    header, payload = value[5:].split(",", 1)
+    parts = header.split(";")
+    mime = parts[0] or "application/octet-stream"
+    try:
+        data = base64.b64decode(payload) if "base64" in parts[1:] else unquote_to_bytes(payload)
+    except ValueError:
+        return None
+    return mime, data
+
+
+async def externalize_content(session, content: str) -> str:
+    """Если в сообщении inline `data:` медиа — кладём его в хранилище и возвращаем ссылку."""
+    filename = None
+    data_url = content
+    if content.startswith(FILE_PREFIX) and "]" in content:
+        close = content.index("]")
+        filename, data_url = content[len(FILE_PREFIX):close], content[close + 1:]
+    parsed = parse_data_url(data_url)
+    if not parsed:
+        return content
+    mime, data = parsed
+    digest, size = await blob_store.save_bytes(data)
+    await register_blob(session, digest, size, mime)
+    return media_reference(digest, mime, filename)
+
+
+def parse_range(header: str, size: int):
+    """Один диапазон `bytes=a-b` -> (start, end) включительно; ValueError, если он вне файла."""
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+def _file_chunks(path: str, start: int, length: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def blob_response(request: Request, digest: str, mime: str) -> Response:
+    """Отдаёт блоб с ETag, долгим кэшем и поддержкой Range (перемотка голосовых)."""
+    path = blob_store.path_for(digest)
+    size = os.path.getsize(path)
+    etag = f'"{digest}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes",
+    }
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    range_header = request.headers.get("range")
+    if range_header and request.headers.get("if-range", etag) == etag:
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        if byte_range:
+            start, end = byte_range
+            headers.update({"Content-Range": f"bytes {start}-{end}/{size}", "Content-Length": str(end - start + 1)})
+            return StreamingResponse(_file_chunks(path, start, end - start + 1), status_code=206, media_type=mime, headers=headers)
+    headers["Content-Length"] = str(size)
+    return StreamingResponse(_file_chunks(path, 0, size), media_type=mime, headers=headers)
+
+
+async def migrate_inline_media(batch_size: int = 200) -> int:
+    """
+    Переносит старые `data:` сообщения в хранилище. Идём по id порциями,
+    каждая порция — отдельная транзакция, так что повторный запуск просто
+    продолжит с того, что осталось.
+    """
+    last_id, migrated = 0, 0
+    while True:
+        async with AsyncSessionLocal() as session:
+            rows = (
+                await session.execute(
+                    text(
+                        "SELECT id, content FROM messages WHERE id > :last "
+                        "AND (content LIKE 'data:%' OR content LIKE '[FILE:%]data:%') ORDER BY id LIMIT :n"
+                    ),
+                    {"last": last_id, "n": batch_size},
+                )
+            ).fetchall()
+            if not rows:
+                return migrated
+            for message_id, content in rows:
+                reference = await externalize_content(session, content)
+                if reference != content:
+                    await session.execute(text("UPDATE messages SET content=:c WHERE id=:id"), {"c": reference, "id": message_id})
+                    migrated += 1
+            await session.commit()
+            last_id = rows[-1][0]
+            print(f"migrated {migrated} messages (last id {last_id})")
+
+
+if __name__ == "__main__":
+    from database import init_db
+
+    async def _main():
+        await init_db()
+        print(f"done: {await migrate_inline_media()} messages moved to {BLOB_DIR}")
+
+    asyncio.run(_main())
@@ -0,0 +1,201 @@
+"""
+Команды бота (/gif, /weather, /joke, /help).
+
+Команда регистрируется декоратором @command и выполняется фоновой задачей:
+сокет отправителя не ждёт внешний API. У каждой команды свой таймаут (на
+ожидание слота и сам вызов) и лимит одновременных вызовов; ответы кэшируются
+по (команда, аргументы) на ttl секунд, одинаковые кэшируемые запросы в
+полёте склеиваются. Все HTTP-вызовы идут через одну общую aiohttp-сессию,
+а адреса внешних API берутся из BOT_*_URL — так команды можно гонять
+против локальной заглушки (benchmarks/bench_bots.py).
+"""
+import asyncio
+import os
+import random
+from urllib.parse import quote
+
+import aiohttp
+
+from cache import TTLCache
+
+GIPHY_URL = os.getenv("BOT_GIPHY_URL", "https://api.giphy.com/v1/gifs/random")
+GIPHY_API_KEY = os.getenv("GIPHY_API_KEY", "dc6zaTOxFJmzC")
+WEATHER_URL = os.getenv("BOT_WEATHER_URL", "http://wttr.in")
+BOT_TIMEOUT = float(os.getenv("BOT_TIMEOUT", "5"))
+BOT_MAX_TASKS = int(os.getenv("BOT_MAX_TASKS", "200"))
+
+commands: dict = {}
+_cache = TTLCache(maxsize=2000, ttl=600)
+_inflight: dict = {}
+_tasks: set = set()
+_reply = None
+_http: aiohttp.ClientSession = None
+counters = {"run": 0, "cached": 0, "timeouts": 0, "errors": 0, "rejected": 0}
+
+
+class Command:
+    __slots__ = ("name", "handler", "usage", "timeout", "ttl", "concurrency", "limit", "error")
+
+    def __init__(self, name, handler, usage, timeout, ttl, concurrency, error):
+        self.name = name
+        self.handler = handler
+        self.usage = usage
+        self.timeout = timeout
+        self.ttl = ttl
+        self.concurrency = concurrency
+        self.limit = asyncio.Semaphore(concurrency)
+        self.error = error
+
+
+def command(name: str, usage: str, timeout: float = BOT_TIMEOUT, ttl: float = 0, concurrency: int = 4, error: str = "❌ Команда не ответила"):
+    """
+    Регистрирует async handler(args) -> str | None.
+    ttl > 0 — кэшировать ответ; error — что ответить при таймауте или ошибке
+    (может содержать {args}).
+    """
+    def register(handler):
+        commands[name] = Command(name, handler, usage, timeout, ttl, concurrency, error)
+        return handler
+    return register
+
+
+def http() -> aiohttp.ClientSession:
+    global _http
+    if _http is None or _http.closed:
+        _http = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=BOT_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300),
+            headers={"User-Agent": "FluxBot/1.0"},
+        )
+    return _http
+
+
+@command("/gif", "/gif [тег] - случайный GIF", error="❌ Ошибка загрузки GIF")
+async def gif(args: str):
+    async with http().get(GIPHY_URL, params={"api_key": GIPHY_API_KEY, "tag": args or "funny"}) as resp:
+        gif_data = await resp.json(content_type=None)
+    url = (gif_data.get("data") or {}).get("images", {}).get("original", {}).get("url")
+    return f"🎬 {url}" if url else "❌ Ошибка загрузки GIF"
+
+
+@command("/weather", "/weather [город] - погода", ttl=600, concurrency=8, error="❌ Не удалось получить погоду для {args}")
+async def weather(args: str):
+    if not args:
+        return "🌤️ Использование: /weather <город>"
+    async with http().get(f"{WEATHER_URL}/{quote(args)}", params={"format": "3"}) as resp:
+        resp.raise_for_status()
+        return f"🌡️ {(await resp.text()).strip()}"
+
+
+JOKES = [
+    "Почему программисты не любят природу? Там слишком много багов!",
+    "Что говорит один байт другому? Мы встретимся на мегабайте!",
+    "Почему Python не может летать? Потому что это змея!",
+    "Как называется программист, который не пьет кофе? Сонный.",
+    "Почему JavaScript разработчики носят очки? Потому что не могут C#!",
+]
+
+
+@command("/joke", "/joke - случайная шутка")
+async def joke(args: str):
+    return f"😄 {random.choice(JOKES)}"
+
+
+@command("/help", "/help - эта справка")
+async def help_(args: str):
+    return "📋 Доступные команды:\n" + "\n".join(c.usage for c in commands.values())
+
+
+def parse(content: str):
+    """'/weather Москва' -> (Command, 'Москва') или None, если такой команды нет."""
+    if not content.startswith("/"):
+        return None
+    parts = content.split(" ", 1)
+    cmd = commands.get(parts[0].lower())
+    return (cmd, parts[1].strip() if len(parts) > 1 else "") if cmd else None
+
+
+async def _call(cmd: Command, args: str):
+    async with cmd.limit:
+        return await cmd.handler(args)
+
+
+async def execute(cmd: Command, args: str) -> str:
+    """Ответ команды: кэш -> уже идущий такой же вызов -> вызов с таймаутом."""
+    if not cmd.ttl:
+        return await _execute(cmd, args)
+    key = (cmd.name, args.lower())
+    cached = _cache.get(key)
+    if cached is not None:
+        counters["cached"] += 1
+        return cached
+    if key in _inflight:
+        return await asyncio.shield(_inflight[key])
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        result = await _execute(cmd, args, key)
+        future.set_result(result)
+        return result
+    except BaseException:
+        future.cancel()
+        raise
+    finally:
+        _inflight.pop(key, None)
+
+
+async def _execute(cmd: Command, args: str, key=None) -> str:
+    counters["run"] += 1
+    try:
+        result = await asyncio.wait_for(_call(cmd, args), cmd.timeout)
+    except asyncio.TimeoutError:
+        counters["timeouts"] += 1
+        return cmd.error.format(args=args)
+    except Exception as e:
+        counters["errors"] += 1
+        print(f"Bot command {cmd.name} error: {e}")
+        return cmd.error.format(args=args)
+    if result and key:
+        _cache.set(key, result, ttl=cmd.ttl)
+    return result
+
+
+async def _run(cmd: Command, args: str, channel: str):
+    result = await execute(cmd, args)
+    if result and _reply:
+        try:
+            await _reply(channel, result)
+        except Exception as e:
+            print(f"Bot reply error: {e}")
+
+
+def dispatch(content: str, channel: str) -> bool:
+    """Запускает команду в фоне; False — это не команда, сообщение обрабатывается как обычное."""
+    parsed = parse(content)
+    if not parsed:
+        return False
+    if len(_tasks) >= BOT_MAX_TASKS:
+        counters["rejected"] += 1
+        return True
+    task = asyncio.create_task(_run(*parsed, channel))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return True
+
+
+def start(reply):
+    """reply(channel, text) — публикация ответа от имени бота."""
+    global _reply
+    _reply = reply
+
+
+async def stop():
+    for task in list(_tasks):
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    if _http is not None and not _http.closed:
+        await _http.close()
+
+
+def stats() -> dict:
+    return {**counters, "running": len(_tasks), "inflight": len(_inflight), "cache": _cache.stats()}
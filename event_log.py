@@ -0,0 +1,119 @@
+"""
+Журнал событий канала для догоняющей синхронизации.
+
+Каждое изменение канала (новое сообщение, правка, удаление, реакция,
+закреп, превью ссылки) получает seq — монотонный номер внутри канала — и
+пишется в channel_events в той же транзакции, что и само изменение. Клиент
+запоминает последний увиденный seq и после переподключения командой sync
+получает только пропущенное. Журнал хранится EVENT_LOG_RETENTION_DAYS дней;
+если клиент отстал сильнее, ему отвечаем reset и он перезагружает историю.
+"""
+import asyncio
+import json
+import os
+
+from sqlalchemy import text
+
+from database import AsyncSessionLocal
+
+EVENT_LOG_RETENTION_DAYS = int(os.getenv("EVENT_LOG_RETENTION_DAYS", "7"))
+SYNC_PAGE_MAX = 500
+
+# Строка channel_seqs блокируется до коммита, так что номера в канале идут без гонок
+ALLOCATE_SQL = """
+    INSERT INTO channel_seqs (channel, last_seq) VALUES (:ch, :n)
+    ON CONFLICT (channel) DO UPDATE SET last_seq = channel_seqs.last_seq + EXCLUDED.last_seq
+    RETURNING last_seq
+"""
+APPEND_SQL = """
+    INSERT INTO channel_events (channel, seq, message_id, payload)
+    SELECT :ch, * FROM unnest(CAST(:seq AS bigint[]), CAST(:mid AS int[]), CAST(:p AS text[]))
+"""
+SINCE_SQL = """
+    SELECT seq, payload FROM channel_events
+    WHERE channel=:ch AND seq > :since AND payload IS NOT NULL
+    ORDER BY seq LIMIT :lim
+"""
+
+_task: asyncio.Task = None
+
+
+async def append(session, channel: str, events: list[dict]) -> list[dict]:
+    """Проставляет событиям канала seq и пишет их в журнал. Коммит — за вызывающим."""
+    if not events:
+        return events
+    last = (await session.execute(text(ALLOCATE_SQL), {"ch": channel, "n": len(events)})).scalar()
+    for seq, event in enumerate(events, start=last - len(events) + 1):
+        event["seq"] = seq
+    await session.execute(
+        text(APPEND_SQL),
+        {
+            "ch": channel,
+            "seq": [e["seq"] for e in events],
+            "mid": [e.get("message_id", e.get("id")) for e in events],
+            "p": [json.dumps(e) for e in events],
+        },
+    )
+    return events
+
+
+async def forget_message(session, channel: str, message_id: int):
+    """Удалённое сообщение не должно всплыть при sync: стираем его события из журнала."""
+    await session.execute(
+        text("UPDATE channel_events SET payload=NULL WHERE channel=:ch AND message_id=:id"),
+        {"ch": channel, "id": message_id},
+    )
+
+
+async def events_since(session, channel: str, since: int, limit: int = SYNC_PAGE_MAX) -> dict:
+    limit = max(1, min(int(limit or SYNC_PAGE_MAX), SYNC_PAGE_MAX))
+    since = int(since or 0)
+    row = (
+        await session.execute(
+            text("SELECT s.last_seq, (SELECT min(seq) FROM channel_events e WHERE e.channel=s.channel) FROM channel_seqs s WHERE s.channel=:ch"),
+            {"ch": channel},
+        )
+    ).fetchone()
+    last_seq, oldest = (row[0], row[1]) if row else (0, None)
+    # Клиент из будущего или журнал уже подрезан дальше, чем клиент видел
+    if since > last_seq or (since < last_seq and (oldest is None or oldest > since + 1)):
+        return {"reset": True, "events": [], "last_seq": last_seq, "has_more": False}
+    rows = (await session.execute(text(SINCE_SQL), {"ch": channel, "since": since, "lim": limit + 1})).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "reset": False,
+        "events": [json.loads(r[1]) for r in rows],
+        # До какого seq клиент догнал (с учётом стёртых событий удалённых сообщений)
+        "last_seq": rows[-1][0] if has_more else last_seq,
+        "has_more": has_more,
+    }
+
+
+async def trim():
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            text("DELETE FROM channel_events WHERE created_at < now() - make_interval(days => :d)"),
+            {"d": EVENT_LOG_RETENTION_DAYS},
+        )
+        await session.commit()
+
+
+async def _run():
+    while True:
+        try:
+            await trim()
+        except Exception as e:
+            print(f"Event log trim error: {e}")
+        await asyncio.sleep(3600)
+
+
+def start():
+    global _task
+    _task = asyncio.create_task(_run())
+
+
+async def stop():
+    if _task:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
@@ -0,0 +1,206 @@
+"""
+Фоновая генерация превью ссылок.
+
+Сообщение рассылается сразу, а превью считает пул воркеров: одна общая
+aiohttp-сессия, скачивание потоком с лимитом по байтам, результат — в
+TTL/LRU-кэш по нормализованному URL и в таблицу link_previews. Когда превью
+готово, вызывается колбэк on_ready (он пишет превью в сообщение и рассылает
+событие link_preview).
+"""
+import asyncio
+import json
+import os
+import re
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import aiohttp
+from sqlalchemy import text
+
+from cache import TTLCache
+from database import AsyncSessionLocal
+
+PREVIEW_WORKERS = int(os.getenv("PREVIEW_WORKERS", "4"))
+PREVIEW_QUEUE_SIZE = int(os.getenv("PREVIEW_QUEUE_SIZE", "1000"))
+PREVIEW_MAX_BYTES = int(os.getenv("PREVIEW_MAX_BYTES", str(512 * 1024)))
+PREVIEW_TIMEOUT = float(os.getenv("PREVIEW_TIMEOUT", "5"))
+PREVIEW_TTL = int(os.getenv("PREVIEW_TTL", str(24 * 3600)))
+URL_RE = re.compile(r'https?://[^\s]+')
+
+_cache = TTLCache(maxsize=5000, ttl=PREVIEW_TTL)
+_queue: asyncio.Queue = None
+_workers: list = []
+_inflight: dict = {}
+_http: aiohttp.ClientSession = None
+
+
+def normalize_url(url: str) -> str:
+    """Ключ кэша: без фрагмента, utm-меток, порта по умолчанию и регистра хоста."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and not ((scheme == "http" and parts.port == 80) or (scheme == "https" and parts.port == 443)):
+        host = f"{host}:{parts.port}"
+    query = urlencode([(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not k.startswith("utm_")])
+    return urlunsplit((scheme, host, parts.path or "/", query, ""))
+
+
+def parse_preview(url: str, html: str) -> dict:
+    # Простой парсинг meta тегов
+    title_match = re.search(r'<title>(.*?)</title>', html, re.IGNORECASE | re.DOTALL)
+    og_title = re.search(r'<meta\s+property=["\']og:title["\']\s+content=["\']([^"\']+)["\']', html, re.IGNORECASE)
+    og_desc = re.search(r'<meta\s+property=["\']og:description["\']\s+content=["\']([^"\']+)["\']', html, re.IGNORECASE)
+    og_image = re.search(r'<meta\s+property=["\']og:image["\']\s+content=["\']([^"\']+)["\']', html, re.IGNORECASE)
+
+    title = (og_title.group(1) if og_title else None) or (title_match.group(1).strip() if title_match else None) or "Ссылка"
+    desc = og_desc.group(1) if og_desc else None
+    image = og_image.group(1) if og_image else None
+
+    # YouTube специальная обработка
+    if "youtube.com" in url or "youtu.be" in url:
+        video_id = re.search(r'(?:v=|/)([0-9A-Za-z_-]{11})', url)
+        if video_id:
+            image = f"https://img.youtube.com/vi/{video_id.group(1)}/maxresdefault.jpg"
+
+    return {"title": title[:100], "description": desc[:200] if desc else None, "image": image, "url": url}
+
+
+def _http_session() -> aiohttp.ClientSession:
+    global _http
+    if _http is None or _http.closed:
+        _http = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=PREVIEW_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=PREVIEW_WORKERS * 4, ttl_dns_cache=300),
+            headers={"User-Agent": "FluxBot/1.0 (+link preview)"},
+        )
+    return _http
+
+
+async def fetch_preview(url: str) -> dict:
+    """Качает страницу не больше PREVIEW_MAX_BYTES и разбирает meta-теги."""
+    try:
+        async with _http_session().get(url) as resp:
+            if resp.status != 200:
+                return {"error": "Failed to fetch"}
+            if "html" not in resp.headers.get("Content-Type", "text/html"):
+                return {"error": "Not a page"}
+            body = bytearray()
+            async for chunk in resp.content.iter_chunked(16 * 1024):
+                body.extend(chunk)
+                if len(body) >= PREVIEW_MAX_BYTES:
+                    break
+            html = body[:PREVIEW_MAX_BYTES].decode(resp.charset or "utf-8", errors="ignore")
+            return parse_preview(url, html)
+    except Exception as e:
+        return {"error": str(e)}
+
+
+async def _load_stored(key: str):
+    async with AsyncSessionLocal() as session:
+        row = (
+            await session.execute(
+                text("SELECT data FROM link_previews WHERE url=:u AND fetched_at > now() - make_interval(secs => :ttl)"),
+                {"u": key, "ttl": PREVIEW_TTL},
+            )
+        ).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+async def _store(key: str, preview: dict):
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            text(
+                "INSERT INTO link_previews (url, data, fetched_at) VALUES (:u, :d, now()) "
+                "ON CONFLICT (url) DO UPDATE SET data=EXCLUDED.data, fetched_at=EXCLUDED.fetched_at"
+            ),
+            {"u": key, "d": json.dumps(preview)},
+        )
+        await session.commit()
+
+
+def cached_preview(url: str):
+    """Превью из памяти без ожидания (None, если его там нет)."""
+    return _cache.get(normalize_url(url))
+
+
+async def get_preview(url: str) -> dict:
+    """Память -> таблица link_previews -> сеть. Одинаковые URL качаются один раз."""
+    key = normalize_url(url)
+    preview = _cache.get(key)
+    if preview is not None:
+        return preview
+    if key in _inflight:
+        shared = _inflight[key]
+        try:
+            return await asyncio.shield(shared)
+        except asyncio.CancelledError:
+            # Отменили владельца загрузки, а не нас — грузим сами
+            if not shared.cancelled():
+                raise
+            return await get_preview(url)
+    future = asyncio.get_running_loop().create_future()
+    # Ошибку получает и сам вызывающий; если больше никто не ждёт, забираем её, чтобы asyncio не ругался
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    _inflight[key] = future
+    try:
+        preview = await _load_stored(key)
+        if preview is None:
+            preview = await fetch_preview(url)
+            if preview.get("title"):
+                await _store(key, preview)
+        # Ошибки тоже кэшируем, но ненадолго, чтобы не долбить лежащий сайт
+        _cache.set(key, preview, ttl=None if preview.get("title") else 300)
+        future.set_result(preview)
+        return preview
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    except BaseException:
+        # Владельца отменили (CancelledError) — будим ждущих, иначе они висят вечно
+        future.cancel()
+        raise
+    finally:
+        _inflight.pop(key, None)
+
+
+def enqueue(message_id: int, channel: str, url: str) -> bool:
+    """Ставит превью в очередь; при переполнении просто пропускаем его."""
+    if _queue is None:
+        return False
+    try:
+        _queue.put_nowait((message_id, channel, url))
+        return True
+    except asyncio.QueueFull:
+        return False
+
+
+async def _worker(on_ready):
+    while True:
+        message_id, channel, url = await _queue.get()
+        try:
+            preview = await get_preview(url)
+            if preview.get("title"):
+                await on_ready(message_id, channel, preview)
+        except Exception as e:
+            print(f"Link preview error: {e}")
+        finally:
+            _queue.task_done()
+
+
+def start(on_ready):
+    global _queue
+    _queue = asyncio.Queue(maxsize=PREVIEW_QUEUE_SIZE)
+    for _ in range(PREVIEW_WORKERS):
+        _workers.append(asyncio.create_task(_worker(on_ready)))
+
+
+async def stop():
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    if _http is not None and not _http.closed:
+        await _http.close()
+
+
+def stats() -> dict:
+    return {"queue": _queue.qsize() if _queue else 0, "inflight": len(_inflight), "cache": _cache.stats()}
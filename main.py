@@ -1,24 +1,45 @@
+import asyncio
+import itertools
 import json
 import re
+import time
 from datetime import datetime
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request, UploadFile, File
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from sqlalchemy import text
-from database import AsyncSessionLocal, init_db
-from passlib.context import CryptContext
-import aiohttp
+from database import db_session, init_db, parse_cursor, parse_int, pool_stats, session_scope
+from backplane import Backplane, create_backplane
+from search import SEARCH_PAGE_SIZE, search_messages
+from blobstore import BlobTooLarge, blob_response, blob_store, externalize_content, has_inline_data, iter_upload, media_reference, register_blob
+import bots
+import event_log
+import link_previews
+import profiles
+import purge
+import stickers
+import user_ids
+import outbox
+import passwords
+import wire
+from activity import activity
+from presence import presence
+from spy_expiry import spy_expiry
+from voice import voice
 
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
 
-def get_password_hash(password): return pwd_context.hash(password)
-def verify_password(plain, hashed): 
-    try: return pwd_context.verify(plain, hashed)
-    except: return False
+@app.middleware("http")
+async def request_session(request: Request, call_next):
+    # Все db_session() одного запроса делят одну сессию, а не берут по соединению на каждый блок
+    async with session_scope():
+        return await call_next(request)
+
+def hashing_busy():
+    return HTTPException(503, "Сервер перегружен, попробуйте через пару секунд", headers={"Retry-After": "2"})
 
 class AuthModel(BaseModel): 
     username: str; password: str; real_name: str = ""; birth_date: str = ""
@@ -41,63 +62,473 @@ class GetUsersModel(BaseModel): query: str
 class SetRoleModel(BaseModel): group_id: int; username: str; role: str
 class NotificationSettingsModel(BaseModel): username: str; settings: dict
 class UserIdUpdateModel(BaseModel): username: str; new_user_id: str
-class StickerModel(BaseModel): name: str; pack_name: str; sticker_data: str; is_animated: bool = False
-class StickerPackModel(BaseModel): name: str; title: str; icon: str = None
+class StickerModel(BaseModel): name: str; pack_name: str; sticker_data: str; is_animated: bool = False; created_by: str = ""
+class StickerPackModel(BaseModel): name: str; title: str; icon: str = None; created_by: str = ""
 class AddStickerPackModel(BaseModel): username: str; pack_id: int
 
 @app.on_event("startup")
 async def startup():
     await init_db()
+    await manager.start()
+    link_previews.start(on_link_preview_ready)
+    bots.start(on_bot_reply)
+    activity.start()
+    presence.start(presence_recipients, manager.send_personal_batch, manager.publish)
+    event_log.start()
+    await spy_expiry.start(manager.publish)
+    purge.start(lambda user, event: manager.send_personal_message(event, user))
+    await voice.start(manager.deliver_local, manager.online_users, manager.ask)
+
+@app.on_event("shutdown")
+async def shutdown():
+    await link_previews.stop()
+    await bots.stop()
+    await activity.stop()
+    await presence.stop()
+    await event_log.stop()
+    await spy_expiry.stop()
+    await purge.stop()
+    await voice.stop()
+    await manager.stop()
+
+def dm_channel(user1: str, user2: str) -> str:
+    u1, u2 = sorted([user1, user2])
+    return f"dm_{u1}_{u2}"
+
+async def get_user_channels(session, username: str) -> set[str]:
+    """Все каналы (лички и группы), в которых состоит пользователь."""
+    channels = set()
+    res = await session.execute(text("SELECT user1, user2 FROM dms WHERE user1=:u OR user2=:u"), {"u":username})
+    for r in res.fetchall(): channels.add(dm_channel(r[0], r[1]))
+    res = await session.execute(text("SELECT group_id FROM group_members WHERE username=:u"), {"u":username})
+    for r in res.fetchall(): channels.add(f"group_{r[0]}")
+    return channels
+
+CONTACTS_SQL = """
+    SELECT user1, user2 FROM dms WHERE user1 = ANY(CAST(:us AS text[]))
+    UNION SELECT user2, user1 FROM dms WHERE user2 = ANY(CAST(:us AS text[]))
+    UNION SELECT me.username, other.username FROM group_members me JOIN group_members other ON other.group_id = me.group_id
+        WHERE me.username = ANY(CAST(:us AS text[]))
+"""
+
+async def get_contacts_many(session, usernames: list[str]) -> dict[str, set[str]]:
+    """Контакты сразу нескольких пользователей одним запросом: username -> ники."""
+    contacts = {}
+    for user, other in (await session.execute(text(CONTACTS_SQL), {"us": list(usernames)})).fetchall():
+        contacts.setdefault(user, set()).add(other)
+    return contacts
+
+async def get_user_contacts(session, username: str) -> set[str]:
+    """С кем у пользователя есть личка или общая группа — только их статусы ему интересны."""
+    return (await get_contacts_many(session, [username])).get(username, set())
+
+async def presence_recipients(usernames: list[str]) -> dict[str, set[str]]:
+    """Кому показывать статусы: онлайн-контактам (со всех воркеров) каждого из usernames."""
+    async with db_session() as session:
+        contacts = await get_contacts_many(session, usernames)
+    online = manager.online_users()
+    return {user: peers & online for user, peers in contacts.items()}
+
+# Воркер раз в PRESENCE_HEARTBEAT секунд рассказывает остальным, кто у него онлайн;
+# воркер, молчащий дольше PRESENCE_EXPIRY, считается упавшим и его пользователи — офлайн
+PRESENCE_HEARTBEAT = 15
+PRESENCE_EXPIRY = 45
+
+class Connection:
+    """Один сокет пользователя (вкладка, телефон); __slots__, чтобы 100k сокетов не раздували память."""
+    __slots__ = ("id", "username", "websocket", "outbox", "proto")
+    def __init__(self, id: int, username: str, websocket: WebSocket, proto: str = "json"):
+        self.id = id
+        self.username = username
+        self.websocket = websocket
+        self.outbox = outbox.Outbox(websocket)
+        self.proto = proto
+    def send(self, data) -> bool:
+        """Ответ только этому устройству — через ту же очередь, что и рассылки."""
+        key, droppable = outbox.policy_for(data)
+        return self.outbox.put(wire.encode(data, self.proto), key, droppable)
 
 class ConnectionManager:
-    def __init__(self): self.active_connections: dict[str, WebSocket] = {}
-    async def connect(self, websocket: WebSocket, username: str):
-        # При подключении сразу шлём список уже онлайн-юзеров,
+    """
+    Сокеты этого воркера плюс бэкплейн: каждое событие доставляется своим
+    сокетам сразу и пересылается остальным воркерам, которые доставляют его своим.
+    """
+    def __init__(self, backplane: Backplane):
+        # Пользователь -> его устройства (id соединения -> Connection)
+        self.active_connections: dict[str, dict[int, Connection]] = {}
+        self.connection_count = 0
+        self._connection_ids = itertools.count(1)
+        # Реестр подписок: канал -> онлайн-участники и обратный индекс пользователь -> каналы
+        self.channel_subscribers: dict[str, set[str]] = {}
+        self.user_channels: dict[str, set[str]] = {}
+        self.backplane = backplane
+        # Онлайн на других воркерах: worker_id -> ники и время последнего сигнала от воркера
+        self.remote_users: dict[str, set[str]] = {}
+        self.remote_seen: dict[str, float] = {}
+        # Дополнительные операции бэкплейна: op -> обработчик(event)
+        self.handlers: dict = {}
+        # Запросы к другим воркерам (ask): request_id -> ожидание ответов
+        self._requests: dict[int, dict] = {}
+        self._request_ids = itertools.count(1)
+        self._heartbeat_task: asyncio.Task = None
+    async def start(self):
+        await self.backplane.start(self._on_remote)
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        await self._relay({"op": "hello"})
+    async def stop(self):
+        if self._heartbeat_task: self._heartbeat_task.cancel()
+        await self._relay({"op": "bye"})
+        await self.backplane.stop()
+    async def connect(self, websocket: WebSocket, username: str) -> Connection:
+        # При подключении сразу шлём, кто из контактов онлайн (со всех воркеров),
         # чтобы клиент мог подсветить статусы, как в Discord/Telegram.
         await websocket.accept()
+        conn = Connection(next(self._connection_ids), username, websocket, wire.negotiate(websocket.query_params.get("proto")))
+        conn.outbox.start()
+        async with db_session() as session:
+            contacts = await get_user_contacts(session, username)
+            channels = await get_user_channels(session, username)
+        conn.send({"type": "initial_status", "users": list(contacts & self.online_users())})
+        was_online = username in self.online_users()
+        devices = self.active_connections.setdefault(username, {})
+        first_device = not devices
+        devices[conn.id] = conn
+        self.connection_count += 1
+        if first_device:
+            # Подписки и присутствие — на пользователя, второе устройство их только разделяет
+            for channel in channels: self._subscribe_local(username, channel)
+            await self._relay({"op": "presence", "username": username, "online": True})
+        if not was_online:
+            presence.set_status(username, "online")
+        return conn
+    def disconnect(self, conn: Connection) -> bool:
+        """Убирает устройство; True, если это было последнее устройство пользователя."""
+        devices = self.active_connections.get(conn.username)
+        conn.outbox.close()
+        if not devices or devices.pop(conn.id, None) is None: return False
+        self.connection_count -= 1
+        if devices: return False
+        del self.active_connections[conn.username]
+        for channel in self.user_channels.pop(conn.username, set()):
+            self._drop_subscriber(channel, conn.username)
+        return True
+    async def went_offline(self, username: str):
+        """После disconnect: сообщаем воркерам и, если пользователя больше нигде нет, клиентам (кадром presence)."""
+        await self._relay({"op": "presence", "username": username, "online": False})
+        if username not in self.online_users():
+            presence.set_status(username, "offline")
+            # Голосовой канал держится, только пока пользователь где-то подключён
+            if voice.room_of(username) is not None: await self.emit(voice.leave_event(username))
+    def online_users(self) -> set[str]:
+        now = time.monotonic()
+        users = set(self.active_connections)
+        for worker, seen in list(self.remote_seen.items()):
+            if now - seen > PRESENCE_EXPIRY:
+                self.remote_seen.pop(worker, None); self.remote_users.pop(worker, None)
+            else:
+                users |= self.remote_users.get(worker, set())
+        return users
+    async def subscribe(self, username: str, channel: str):
+        await self.emit({"op": "subscribe", "username": username, "channel": channel})
+    def _subscribe_local(self, username: str, channel: str):
+        # Подписываем только онлайн-пользователей: офлайн подтянут каналы при connect
+        if username not in self.active_connections: return
+        self.channel_subscribers.setdefault(channel, set()).add(username)
+        self.user_channels.setdefault(username, set()).add(channel)
+    def unsubscribe(self, username: str, channel: str):
+        if channel in self.user_channels.get(username, ()):
+            self.user_channels[username].discard(channel)
+        self._drop_subscriber(channel, username)
+    def _drop_subscriber(self, channel: str, username: str):
+        members = self.channel_subscribers.get(channel)
+        if members is None: return
+        members.discard(username)
+        if not members: del self.channel_subscribers[channel]
+    async def _fan_out(self, usernames, data: dict):
+        # Сериализуем один раз на формат и раскладываем по очередям устройств — отправят их писатели
+        targets = [conn for u in usernames for conn in self.active_connections.get(u, {}).values()]
+        if not targets: return
+        payloads = {}
+        key, droppable = outbox.policy_for(data)
+        for conn in targets:
+            if conn.proto not in payloads: payloads[conn.proto] = wire.encode(data, conn.proto)
+            conn.outbox.put(payloads[conn.proto], key, droppable)
+    async def emit(self, event: dict):
+        """Выполняет операцию на этом воркере и пересылает её остальным."""
+        await self._apply(event)
+        await self._relay(event)
+    async def _relay(self, event: dict):
+        try: await self.backplane.publish(event)
+        except Exception as e: print(f"Backplane publish error: {e}")
+    async def _apply(self, event: dict):
+        op = event["op"]
+        if op == "publish": await self._fan_out(list(self.channel_subscribers.get(event["channel"], ())), event["data"])
+        elif op == "broadcast": await self._fan_out(list(self.active_connections), event["data"])
+        elif op == "personal":
+            await self._fan_out([event["username"]], event["data"])
+        elif op == "personal_batch":
+            # Свой кадр каждому получателю; воркер доставляет только тем, кто подключён к нему
+            for username, data in event["frames"].items():
+                if username in self.active_connections: await self._fan_out([username], data)
+        elif op == "subscribe": self._subscribe_local(event["username"], event["channel"])
+        elif op == "kick": await self._kick_local(event["username"])
+        elif op in self.handlers:
+            result = self.handlers[op](event)
+            if asyncio.iscoroutine(result): result = await result
+            if event.get("reply_to"):
+                await self._relay({"op": "reply", "to": event["reply_to"], "request_id": event["request_id"], "result": result})
+    async def ask(self, op: str, event: dict, timeout: float = 0.5, first: bool = False) -> list:
+        """
+        Выполняет op из handlers на остальных воркерах и собирает их ответы; не успевшие за timeout пропускаются.
+        first=True — хватит первого ответа не None; тогда ждём и не зная воркеров: сразу после hello их ответы ещё в пути.
+        """
+        workers = set(self.remote_seen)
+        if not workers and not (first and self.backplane.remote): return []
+        request_id = next(self._request_ids)
+        waiter = self._requests[request_id] = {"waiting": workers, "first": first, "results": [], "done": asyncio.get_running_loop().create_future()}
         try:
-            await websocket.send_text(json.dumps({
-                "type": "initial_status",
-                "users": list(self.active_connections.keys())
-            }))
-        except Exception:
-            # Если по какой-то причине не получилось отправить — не рвём подключение
-            pass
-
-        self.active_connections[username] = websocket
-        await self.broadcast({"type": "status", "username": username, "status": "online"})
-    def disconnect(self, username: str):
-        if username in self.active_connections: del self.active_connections[username]
+            await self._relay({**event, "op": op, "reply_to": self.backplane.worker_id, "request_id": request_id})
+            await asyncio.wait_for(waiter["done"], timeout)
+        except asyncio.TimeoutError: pass
+        finally: self._requests.pop(request_id, None)
+        return waiter["results"]
+    def _on_reply(self, event: dict):
+        waiter = self._requests.get(event["request_id"])
+        if waiter is None or waiter["done"].done() or (not waiter["first"] and event.get("worker") not in waiter["waiting"]): return
+        if waiter["first"] and event["result"] is None: return
+        waiter["waiting"].discard(event["worker"])
+        waiter["results"].append(event["result"])
+        if waiter["first"] or not waiter["waiting"]: waiter["done"].set_result(None)
+    async def _on_remote(self, event: dict):
+        op, worker = event["op"], event.get("worker")
+        if op == "reply":
+            if event["to"] == self.backplane.worker_id: self._on_reply(event)
+            return
+        if op in ("hello", "heartbeat", "presence", "bye"):
+            if op == "hello": await self._relay({"op": "heartbeat", "users": list(self.active_connections)})
+            elif op == "bye": self.remote_seen.pop(worker, None); self.remote_users.pop(worker, None)
+            else:
+                self.remote_seen[worker] = time.monotonic()
+                users = self.remote_users.setdefault(worker, set())
+                if op == "heartbeat": users.clear(); users.update(event["users"])
+                elif event["online"]: users.add(event["username"])
+                else: users.discard(event["username"])
+            return
+        await self._apply(event)
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(PRESENCE_HEARTBEAT)
+            await self._relay({"op": "heartbeat", "users": list(self.active_connections)})
     async def broadcast(self, data: dict):
-        for connection in list(self.active_connections.values()):
-            try: await connection.send_text(json.dumps(data))
-            except: pass 
+        await self.emit({"op": "broadcast", "data": data})
+    async def publish(self, channel: str, data: dict):
+        """Отправляет событие только участникам канала (на всех воркерах)."""
+        await self.emit({"op": "publish", "channel": channel, "data": data})
+    async def deliver_local(self, channel: str, data: dict):
+        """Только сокетам этого воркера: участникам канала, а без канала — всем."""
+        await self._fan_out(list(self.channel_subscribers.get(channel, ())) if channel else list(self.active_connections), data)
     async def send_personal_message(self, message: dict, username: str):
-        if username in self.active_connections:
-            try: await self.active_connections[username].send_text(json.dumps(message))
-            except: pass
+        await self.emit({"op": "personal", "username": username, "data": message})
+    async def send_personal_batch(self, frames: dict[str, dict]):
+        """Разные личные кадры многим пользователям одной операцией бэкплейна."""
+        await self.emit({"op": "personal_batch", "frames": frames})
     async def kick_user(self, username: str):
-        if username in self.active_connections:
-            try: await self.active_connections[username].send_text(json.dumps({"type": "ban"})); await self.active_connections[username].close()
+        await self.emit({"op": "kick", "username": username})
+    async def _kick_local(self, username: str):
+        devices = list(self.active_connections.get(username, {}).values())
+        for conn in devices:
+            # Очередь уже не нужна: останавливаем писателя и отправляем ban напрямую
+            self.disconnect(conn)
+            try: await conn.websocket.send_text(json.dumps({"type": "ban"})); await conn.websocket.close()
             except: pass
-            del self.active_connections[username]
+        if devices: await self.went_offline(username)
+    def stats(self) -> dict:
+        return {"worker": self.backplane.worker_id, "users": len(self.active_connections), "connections": self.connection_count, "channels": len(self.channel_subscribers), "remote_workers": len(self.remote_seen), "online_total": len(self.online_users()), "send_queues": outbox.stats(conn.outbox for devices in self.active_connections.values() for conn in devices.values())}
+
+manager = ConnectionManager(create_backplane())
+manager.handlers["invalidate_profile"] = lambda event: profiles.invalidate(event["username"], event.get("old_user_id"))
+manager.handlers["invalidate_stickers"] = lambda event: stickers.invalidate(event.get("pack_name"), event.get("username"))
+manager.handlers["voice"] = voice.apply
+manager.handlers["voice_state"] = lambda event: voice.state()
+manager.handlers["activity_pending"] = lambda event: activity.pending_for(event["username"])
+
+async def on_link_preview_ready(message_id: int, channel: str, preview: dict):
+    """Превью досчиталось в фоне: сохраняем в сообщение и досылаем участникам канала."""
+    event = {"type": "link_preview", "message_id": message_id, "channel": channel, "link_preview": preview}
+    async with db_session() as session:
+        await session.execute(text("UPDATE messages SET link_preview=:lp WHERE id=:id"), {"lp":json.dumps(preview), "id":message_id})
+        await event_log.append(session, channel, [event])
+        await session.commit()
+    await manager.publish(channel, event)
+
+async def on_bot_reply(channel: str, content: str):
+    """Ответ команды бота из фоновой задачи — своя сессия, не сессия события, которое её запустило."""
+    async with session_scope():
+        await post_messages("🤖 Bot", channel, [{"content": content}], kind=None)
+
+# Реакция ставится или снимается одним атомарным запросом, без чтения-изменения JSON
+TOGGLE_REACTION_SQL = """
+    WITH msg AS (SELECT id, username, channel FROM messages WHERE id=:id),
+    del AS (DELETE FROM message_reactions WHERE message_id=:id AND username=:u AND emoji=:e RETURNING 1),
+    ins AS (
+        INSERT INTO message_reactions (message_id, username, emoji)
+        SELECT id, :u, :e FROM msg WHERE NOT EXISTS (SELECT 1 FROM del)
+        ON CONFLICT DO NOTHING RETURNING 1
+    )
+    SELECT msg.username, msg.channel, EXISTS (SELECT 1 FROM ins) FROM msg
+"""
+READ_WATERMARK_SQL = """
+    INSERT INTO message_reads (channel, username, last_read_id)
+    SELECT channel, :u, id FROM messages WHERE id=:id
+    ON CONFLICT (channel, username) DO UPDATE SET last_read_id = EXCLUDED.last_read_id
+    WHERE message_reads.last_read_id < EXCLUDED.last_read_id
+    RETURNING channel, last_read_id
+"""
+
+async def reaction_counts(session, message_id: int) -> dict:
+    res = await session.execute(text("SELECT emoji, COUNT(*) FROM message_reactions WHERE message_id=:id GROUP BY emoji ORDER BY MIN(created_at)"), {"id":message_id})
+    return {r[0]: r[1] for r in res.fetchall()}
+
+# Вставка пачки сообщений, автор и превью ответа — одним запросом
+INGEST_SQL = """
+    WITH new AS (
+        INSERT INTO messages (username, content, channel, created_at, reply_to, timer, mentions, forwarded_from, link_preview)
+        SELECT * FROM unnest(CAST(:u AS text[]), CAST(:c AS text[]), CAST(:ch AS text[]), CAST(:t AS text[]), CAST(:rep AS int[]),
+                             CAST(:tim AS int[]), CAST(:ment AS text[]), CAST(:fw AS text[]), CAST(:lp AS text[]))
+        RETURNING id, username, content, channel, created_at, reply_to, timer, mentions, forwarded_from, link_preview
+    )
+    SELECT new.id, new.username, new.content, new.channel, new.created_at, new.reply_to, new.timer, new.mentions,
+           new.forwarded_from, new.link_preview, u.avatar_url, u.bio, u.is_admin, u.user_id, p.username, p.content
+    FROM new
+    LEFT JOIN users u ON u.username = new.username
+    LEFT JOIN messages p ON p.id = new.reply_to
+    ORDER BY new.id
+"""
+MAX_MESSAGE_BATCH = 20
+
+async def ingest_messages(session, rows: list[dict]) -> list[dict]:
+    """
+    Вставляет сообщения одним INSERT и возвращает их в том виде, в каком их
+    рассылаем клиентам. Коммит — за вызывающим.
+    """
+    params = {
+        "u": [r["username"] for r in rows], "c": [r["content"] for r in rows], "ch": [r["channel"] for r in rows],
+        "t": [r["created_at"] for r in rows], "rep": [r.get("reply_to") for r in rows], "tim": [r.get("timer") or 0 for r in rows],
+        "ment": [json.dumps(r.get("mentions") or []) for r in rows], "fw": [r.get("forwarded_from") for r in rows],
+        "lp": [json.dumps(r["link_preview"]) if r.get("link_preview") else None for r in rows],
+    }
+    res = await session.execute(text(INGEST_SQL), params)
+    messages = []
+    for r in res.fetchall():
+        messages.append({'id':r[0], 'username':r[1], 'content':r[2], 'channel':r[3], 'created_at':r[4], 'avatar_url':r[10] or "", 'bio':r[11] or "", 'is_admin':r[12] or False, 'is_edited': False, 'reactions': {}, 'reply_to': r[5], 'reply_preview': {"username": r[14], "content": r[15]} if r[14] is not None else None, 'read': False, 'timer': r[6] or 0, 'viewed_at': None, 'mentions': json.loads(r[7]) if r[7] else [], 'forwarded_from': r[8], 'link_preview': json.loads(r[9]) if r[9] else None, 'user_id': r[13] or None})
+    return messages
 
-manager = ConnectionManager()
+async def post_messages(username: str, channel: str, items: list[dict], kind: str = "message") -> list[dict]:
+    """
+    Общий путь для обычных, пересланных, пакетных и бот-сообщений:
+    вставка одним запросом и один коммит, потом рассылка, упоминания и превью ссылок.
+    """
+    now = datetime.now().strftime("%H:%M")
+    rows, urls = [], []
+    for item in items:
+        content = item["content"]
+        # Упоминания @username (без дубликатов) и ссылка для превью; готовое превью из кэша отдаём сразу
+        found = link_previews.URL_RE.findall(content)
+        preview = link_previews.cached_preview(found[0]) if found else None
+        rows.append({"username": username, "content": content, "channel": channel, "created_at": now, "reply_to": item.get("reply_to"), "timer": item.get("timer", 0), "mentions": list(dict.fromkeys(re.findall(r'@(\w+)', content))), "forwarded_from": item.get("forwarded_from"), "link_preview": preview if preview and preview.get("title") else None})
+        urls.append(found[0] if found else None)
+    async with db_session() as session:
+        messages = await ingest_messages(session, rows)
+        if kind:
+            for msg in messages: msg['type'] = kind
+        await event_log.append(session, channel, messages)
+        await session.commit()
+    for msg, url in zip(messages, urls):
+        if url and not msg['link_preview']: link_previews.enqueue(msg['id'], channel, url)
+        await manager.publish(channel, msg)
+        # Отправляем уведомления упомянутым пользователям (не упоминаем себя)
+        short = msg['content'][:50] + "..." if len(msg['content']) > 50 else msg['content']
+        await asyncio.gather(*(manager.send_personal_message({"type": "mention", "message_id": msg['id'], "channel": channel, "from": username, "content": short}, mentioned_user) for mentioned_user in msg['mentions'] if mentioned_user != username))
+    return messages
+
+# Автор и превью ответа подтягиваются JOIN-ами, чтобы история грузилась одним запросом.
+# Страницы режутся по id (keyset) и опираются на индекс (channel, id), поэтому
+# глубокие страницы стоят столько же, сколько первая.
+HISTORY_QUERY = """
+    SELECT m.id, m.username, m.content, m.channel, m.created_at, u.avatar_url, u.bio, u.is_admin, m.is_edited,
+           r.counts, m.reply_to,
+           EXISTS (SELECT 1 FROM message_reads mr WHERE mr.channel = m.channel AND mr.last_read_id >= m.id AND mr.username <> m.username),
+           m.timer, m.viewed_at, m.mentions, m.forwarded_from, m.is_pinned,
+           m.link_preview, m.message_theme, u.user_id, p.username, p.content
+    FROM messages m
+    LEFT JOIN users u ON m.username = u.username
+    LEFT JOIN messages p ON p.id = m.reply_to
+    LEFT JOIN LATERAL (
+        SELECT json_object_agg(emoji, cnt ORDER BY first_at)::text AS counts
+        FROM (SELECT emoji, COUNT(*) AS cnt, MIN(created_at) AS first_at FROM message_reactions WHERE message_id = m.id GROUP BY emoji) x
+    ) r ON TRUE
+    WHERE {where} ORDER BY m.id {order} LIMIT :lim
+"""
+HISTORY_PAGE_SIZE = 50
+HISTORY_PAGE_MAX = 200
+
+def history_row_to_dict(r) -> dict:
+    reply_content = {"username": r[20], "content": r[21]} if r[10] and r[20] is not None else None
+    return {"id": r[0], "username": r[1], "content": r[2], "channel": r[3], "created_at": r[4], "avatar_url": r[5], "bio": r[6], "is_admin": r[7], "is_edited": r[8] or False, "reactions": json.loads(r[9]) if r[9] else {}, "reply_to": r[10], "reply_preview": reply_content, "read": r[11] or False, "timer": r[12] or 0, "viewed_at": r[13], "mentions": json.loads(r[14]) if r[14] else [], "forwarded_from": r[15] or None, "is_pinned": r[16] or False, "link_preview": json.loads(r[17]) if r[17] else None, "message_theme": r[18], "user_id": r[19] or None}
+
+async def load_history_page(session, channel: str, before_id: int = None, after_id: int = None, limit: int = HISTORY_PAGE_SIZE) -> dict:
+    """
+    Страница истории канала (новые сообщения первыми).
+    before_id — листаем назад от этого сообщения, after_id — догружаем то, что новее.
+    """
+    # Параметры могут прийти сырыми из websocket: не-число или id вне INTEGER -> ValueError, его ловит вызывающий
+    before_id, after_id = parse_cursor(before_id), parse_cursor(after_id)
+    limit = max(1, min(parse_int(limit) or HISTORY_PAGE_SIZE, HISTORY_PAGE_MAX))
+    where, params, order = ["m.channel=:ch"], {"ch":channel, "lim":limit + 1}, "DESC"
+    if before_id is not None:
+        where.append("m.id < :before"); params["before"] = before_id
+    if after_id is not None:
+        where.append("m.id > :after"); params["after"] = after_id
+        # Берём ближайшие к after_id сообщения, иначе при большом разрыве потеряем середину
+        if before_id is None: order = "ASC"
+    res = await session.execute(text(HISTORY_QUERY.format(where=" AND ".join(where), order=order)), params)
+    rows = res.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if order == "ASC": rows.reverse()
+    messages = [history_row_to_dict(r) for r in rows]
+    return {
+        "messages": messages,
+        "has_more": has_more,
+        "next_before_id": messages[-1]["id"] if messages else before_id,
+        "next_after_id": messages[0]["id"] if messages else after_id,
+    }
+
+async def load_history(session, channel: str) -> list[dict]:
+    """Последние сообщения канала (новые первыми) в формате, который ждёт фронтенд."""
+    return (await load_history_page(session, channel))["messages"]
+
+@app.get("/stats")
+async def stats():
+    """Внутренние счётчики процесса: кэши, очереди и т.п."""
+    async with db_session() as session:
+        user_id_space = await user_ids.usage(session)
+    return {"db_pool": pool_stats(), "user_ids": user_id_space, "connections": manager.stats(), "presence": presence.stats(), "spy_expiry": spy_expiry.stats(), "passwords": passwords.stats(), "purge": purge.stats(), "profile_cache": profiles.stats(), "link_previews": link_previews.stats(), "stickers": stickers.stats(), "bots": bots.stats(), "voice": voice.stats()}
 
 @app.get("/")
 async def get(request: Request): return templates.TemplateResponse("index.html", {"request": request})
 
 @app.post("/register")
 async def register(user: AuthModel):
-    async with AsyncSessionLocal() as session:
+    # Хэш считаем до похода в БД, чтобы не держать соединение, пока работает Argon2
+    try: password_hash = await passwords.hash_password(user.password)
+    except passwords.HashingBusy: raise hashing_busy()
+    async with db_session() as session:
         if (await session.execute(text("SELECT id FROM users WHERE username=:u"), {"u":user.username})).scalar(): raise HTTPException(400, "Ник занят")
-        # Генерируем уникальный user_id (6-значное число, как в Telegram)
-        import random
-        while True:
-            user_id = str(random.randint(100000, 999999))
-            if not (await session.execute(text("SELECT id FROM users WHERE user_id=:uid"), {"uid":user_id})).scalar():
-                break
-        await session.execute(text("INSERT INTO users (username, password, bio, is_admin, wallpaper, real_name, location, birth_date, social_link, user_id) VALUES (:u, :p, 'Новичок', :a, '', :rn, '', :bd, '', :uid)"), {"u":user.username, "p":get_password_hash(user.password), "a":False, "rn":user.real_name, "bd":user.birth_date, "uid":user_id})
+        # Уникальный user_id (6-значное число, как в Telegram) из заранее перемешанного пула
+        try: user_id = await user_ids.allocate(session)
+        except user_ids.IdSpaceExhausted: raise HTTPException(503, "Свободные ID закончились")
+        await session.execute(text("INSERT INTO users (username, password, bio, is_admin, wallpaper, real_name, location, birth_date, social_link, user_id) VALUES (:u, :p, 'Новичок', :a, '', :rn, '', :bd, '', :uid)"), {"u":user.username, "p":password_hash, "a":False, "rn":user.real_name, "bd":user.birth_date, "uid":user_id})
         exists = (await session.execute(text("SELECT id FROM dms WHERE user1=:u AND user2=:u"), {"u":user.username})).scalar()
         if not exists: await session.execute(text("INSERT INTO dms (user1, user2) VALUES (:u, :u)"), {"u":user.username})
         await session.commit()
@@ -105,27 +536,34 @@ async def register(user: AuthModel):
 
 @app.post("/login")
 async def login(user: AuthModel):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         row = (await session.execute(text("SELECT password, avatar_url, bio, is_admin, real_name, location, birth_date, social_link, wallpaper, user_id FROM users WHERE username=:u"), {"u":user.username})).fetchone()
-        if not row or not verify_password(user.password, row[0]): raise HTTPException(400, "Неверный логин или пароль")
+        if not row: raise HTTPException(400, "Неверный логин или пароль")
+        # Закрываем читающую транзакцию: соединение вернётся в пул на время Argon2
+        await session.commit()
+        try: ok, new_hash = await passwords.verify_password(user.password, row[0])
+        except passwords.HashingBusy: raise hashing_busy()
+        if not ok: raise HTTPException(400, "Неверный логин или пароль")
+        # Параметры Argon2 поменялись — сохраняем пересчитанный хэш
+        if new_hash:
+            await session.execute(text("UPDATE users SET password=:p WHERE username=:u"), {"p":new_hash, "u":user.username})
+            await session.commit()
         # Если у пользователя нет user_id, генерируем его
         if not row[9]:
-            import random
-            while True:
-                user_id = str(random.randint(100000, 999999))
-                if not (await session.execute(text("SELECT id FROM users WHERE user_id=:uid"), {"uid":user_id})).scalar():
-                    await session.execute(text("UPDATE users SET user_id=:uid WHERE username=:u"), {"uid":user_id, "u":user.username})
-                    await session.commit()
-                    break
+            try: user_id = await user_ids.allocate(session)
+            except user_ids.IdSpaceExhausted: raise HTTPException(503, "Свободные ID закончились")
+            await session.execute(text("UPDATE users SET user_id=:uid WHERE username=:u"), {"uid":user_id, "u":user.username})
+            await session.commit()
             return {"message": "Success", "avatar_url": row[1], "bio": row[2], "is_admin": row[3], "real_name": row[4] or "", "location": row[5] or "", "birth_date": row[6] or "", "social_link": row[7] or "", "wallpaper": row[8] or "", "user_id": user_id}
     return {"message": "Success", "avatar_url": row[1], "bio": row[2], "is_admin": row[3], "real_name": row[4] or "", "location": row[5] or "", "birth_date": row[6] or "", "social_link": row[7] or "", "wallpaper": row[8] or "", "user_id": row[9] or ""}
 
 @app.post("/update_profile")
 async def update_profile(data: ProfileUpdateModel):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         q = "UPDATE users SET avatar_url=:a, bio=:b, real_name=:rn, location=:l, birth_date=:bd, social_link=:sl, wallpaper=:w, phone=:p, email=:e WHERE username=:u"
         await session.execute(text(q), {"a":data.avatar_url, "b":data.bio, "u":data.username, "rn":data.real_name, "l":data.location, "bd":data.birth_date, "sl":data.social_link, "w":data.wallpaper, "p":data.phone, "e":data.email})
         await session.commit()
+        await manager.emit({"op": "invalidate_profile", "username": data.username})
         # Берём свежие данные профиля, чтобы отдать фронтенду полный объект,
         # который сразу подойдёт для updateMyUI (аватар, обои, био, админ и т.д.).
         row = (
@@ -166,17 +604,14 @@ async def update_profile(data: ProfileUpdateModel):
 
 @app.get("/get_profile")
 async def get_profile(username: str = None, user_id: str = None):
-    async with AsyncSessionLocal() as session:
-        if user_id:
-            row = (await session.execute(text("SELECT username, bio, avatar_url, is_admin, real_name, location, birth_date, social_link, wallpaper, user_id, phone, email FROM users WHERE user_id=:uid"), {"uid":user_id})).fetchone()
-        else:
-            row = (await session.execute(text("SELECT username, bio, avatar_url, is_admin, real_name, location, birth_date, social_link, wallpaper, user_id, phone, email FROM users WHERE username=:u"), {"u":username})).fetchone()
-        if not row: raise HTTPException(404, "User not found")
-        return {"username": row[0], "bio": row[1], "avatar_url": row[2], "is_admin": row[3], "real_name": row[4] or "", "location": row[5] or "", "birth_date": row[6] or "", "social_link": row[7] or "", "wallpaper": row[8] or "", "user_id": row[9] or "", "phone": row[10] or "", "email": row[11] or ""}
+    async with db_session() as session:
+        profile = await profiles.get_profile(session, username, user_id)
+    if not profile: raise HTTPException(404, "User not found")
+    return profile
 
 @app.post("/send_request")
 async def send_request(data: FriendRequestModel):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         if not (await session.execute(text("SELECT id FROM users WHERE username=:u"), {"u":data.receiver})).scalar(): raise HTTPException(404, "User not found")
         if data.sender == data.receiver: raise HTTPException(400, "Нельзя добавить себя")
         u1, u2 = sorted([data.sender, data.receiver])
@@ -190,29 +625,33 @@ async def send_request(data: FriendRequestModel):
 
 @app.get("/get_requests")
 async def get_requests(username: str):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         res = await session.execute(text("SELECT id, sender FROM friend_requests WHERE receiver=:u AND status='pending'"), {"u":username})
         return [{"id": r[0], "sender": r[1]} for r in res.fetchall()]
 
 @app.post("/respond_request")
 async def respond_request(data: RespondRequestModel):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         req = (await session.execute(text("SELECT sender, receiver FROM friend_requests WHERE id=:id"), {"id":data.request_id})).fetchone()
         if not req: raise HTTPException(404, "Заявка не найдена")
         sender, receiver = req[0], req[1]
+        u1, u2 = sorted([sender, receiver])
         if data.action == "accept":
-            u1, u2 = sorted([sender, receiver])
             await session.execute(text("INSERT INTO dms (user1, user2) VALUES (:u1, :u2)"), {"u1":u1, "u2":u2})
-            # Уведомляем обоих, что они теперь друзья (для обновления списка)
-            await manager.send_personal_message({"type": "request_accepted", "friend": receiver}, sender)
-            await manager.send_personal_message({"type": "request_accepted", "friend": sender}, receiver)
         await session.execute(text("DELETE FROM friend_requests WHERE id=:id"), {"id":data.request_id})
         await session.commit()
+    if data.action == "accept":
+        # Подписки и уведомления — только после коммита, чтобы не показать несуществующую дружбу
+        channel = dm_channel(u1, u2)
+        await manager.subscribe(u1, channel); await manager.subscribe(u2, channel)
+        # Уведомляем обоих, что они теперь друзья (для обновления списка)
+        await manager.send_personal_message({"type": "request_accepted", "friend": receiver}, sender)
+        await manager.send_personal_message({"type": "request_accepted", "friend": sender}, receiver)
     return {"message": "Done"}
 
 @app.get("/get_dms")
 async def get_dms(username: str):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         dms = []
         res = await session.execute(text("SELECT user1, user2 FROM dms WHERE user1=:u OR user2=:u"), {"u":username})
         for r in res.fetchall():
@@ -222,39 +661,79 @@ async def get_dms(username: str):
 
 @app.post("/create_group")
 async def create_group(data: CreateGroupModel):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         gid = (await session.execute(text("INSERT INTO groups (name, owner) VALUES (:n, :o) RETURNING id"), {"n":data.name, "o":data.owner})).scalar()
         await session.execute(text("INSERT INTO group_members (group_id, username) VALUES (:gid, :u)"), {"gid":gid, "u":data.owner})
         await session.commit()
+    await manager.subscribe(data.owner, f"group_{gid}")
     return {"message": "Created", "group_id": gid, "name": data.name}
 
 @app.post("/add_member")
 async def add_member(data: AddMemberModel):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         if not (await session.execute(text("SELECT id FROM users WHERE username=:u"), {"u":data.username})).scalar(): raise HTTPException(404, "User not found")
         try:
             await session.execute(text("INSERT INTO group_members (group_id, username) VALUES (:gid, :u)"), {"gid":data.group_id, "u":data.username})
             await session.commit()
         except: raise HTTPException(400, "Уже в группе")
+    await manager.subscribe(data.username, f"group_{data.group_id}")
     return {"message": "Added"}
 
 @app.get("/get_my_groups")
 async def get_my_groups(username: str):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         res = await session.execute(text("SELECT g.id, g.name FROM groups g JOIN group_members gm ON g.id = gm.group_id WHERE gm.username=:u"), {"u":username})
         return [{"id": r[0], "name": r[1]} for r in res.fetchall()]
 
+@app.get("/history")
+async def get_history(channel: str, username: str, before_id: int = None, after_id: int = None, limit: int = HISTORY_PAGE_SIZE):
+    async with db_session() as session:
+        # Как в /search: историю отдаём только участнику канала
+        if channel not in await get_user_channels(session, username): raise HTTPException(403, "Нет доступа к каналу")
+        try:
+            return await load_history_page(session, channel, before_id, after_id, limit)
+        except ValueError:
+            raise HTTPException(400, "Неверные параметры истории")
+
+@app.post("/upload")
+async def upload(file: UploadFile = File(...)):
+    """Загружает медиа в хранилище; клиент потом шлёт в чат только полученную ссылку."""
+    try:
+        digest, size = await blob_store.save_chunks(iter_upload(file))
+    except BlobTooLarge:
+        raise HTTPException(413, "Файл слишком большой")
+    mime = file.content_type or "application/octet-stream"
+    async with db_session() as session:
+        await register_blob(session, digest, size, mime)
+        await session.commit()
+    filename = None if mime.startswith(("image/", "audio/")) else (file.filename or "file")
+    return {"sha256": digest, "size": size, "mime": mime, "url": f"/blobs/{digest}", "content": media_reference(digest, mime, filename)}
+
+@app.get("/blobs/{digest}")
+async def get_blob(digest: str, request: Request):
+    if not blob_store.exists(digest): raise HTTPException(404, "Not found")
+    async with db_session() as session:
+        mime = (await session.execute(text("SELECT mime FROM blobs WHERE sha256=:h"), {"h":digest})).scalar()
+    return blob_response(request, digest, mime or "application/octet-stream")
+
 @app.get("/search")
-async def search_messages(channel: str, query: str):
-    async with AsyncSessionLocal() as session:
-        res = await session.execute(text("SELECT id, username, content, created_at FROM messages WHERE channel=:ch AND content LIKE :q ORDER BY id DESC"), {"ch": channel, "q": f"%{query}%"})
-        results = []
-        for r in res.fetchall(): results.append({"id": r[0], "username": r[1], "content": r[2], "created_at": r[3]})
-        return results
+async def search(query: str, channel: str = None, username: str = None, limit: int = SEARCH_PAGE_SIZE, cursor: str = None, sort: str = "recent", kind: str = "all"):
+    """Поиск в одном канале или (если channel не задан) во всех каналах пользователя."""
+    async with db_session() as session:
+        if username:
+            allowed = await get_user_channels(session, username)
+            if channel and channel not in allowed: raise HTTPException(403, "Нет доступа к каналу")
+        elif not channel:
+            raise HTTPException(400, "Нужен channel или username")
+        channels = [channel] if channel else allowed
+        try:
+            return await search_messages(session, query, channels, limit, cursor, sort, kind)
+        except ValueError:
+            raise HTTPException(400, "Неверные параметры поиска")
 
 @app.post("/pin_message")
 async def pin_message(data: PinMessageModel):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         # Проверяем, что сообщение существует
         msg = (await session.execute(text("SELECT username FROM messages WHERE id=:id"), {"id":data.message_id})).fetchone()
         if not msg: raise HTTPException(404, "Message not found")
@@ -264,22 +743,27 @@ async def pin_message(data: PinMessageModel):
         now = datetime.now().strftime("%Y-%m-%d %H:%M")
         await session.execute(text("INSERT INTO pinned_messages (message_id, channel, pinned_by, pinned_at) VALUES (:mid, :ch, :by, :at)"), {"mid":data.message_id, "ch":data.channel, "by":data.username, "at":now})
         await session.execute(text("UPDATE messages SET is_pinned=TRUE WHERE id=:id"), {"id":data.message_id})
+        event = {"type": "message_pinned", "message_id": data.message_id, "channel": data.channel}
+        await event_log.append(session, data.channel, [event])
         await session.commit()
-    await manager.broadcast({"type": "message_pinned", "message_id": data.message_id, "channel": data.channel})
+    await manager.publish(data.channel, event)
     return {"message": "Pinned"}
 
 @app.post("/unpin_message")
 async def unpin_message(data: dict):
     message_id = data.get("message_id")
-    async with AsyncSessionLocal() as session:
-        await session.execute(text("DELETE FROM pinned_messages WHERE message_id=:id"), {"id":message_id})
+    async with db_session() as session:
+        channel = (await session.execute(text("DELETE FROM pinned_messages WHERE message_id=:id RETURNING channel"), {"id":message_id})).scalar()
         await session.execute(text("UPDATE messages SET is_pinned=FALSE WHERE id=:id"), {"id":message_id})
+        event = {"type": "message_unpinned", "message_id": message_id, "channel": channel}
+        if channel: await event_log.append(session, channel, [event])
         await session.commit()
+    if channel: await manager.publish(channel, event)
     return {"message": "Unpinned"}
 
 @app.get("/get_pinned")
 async def get_pinned(channel: str):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         res = await session.execute(text("SELECT pm.message_id, pm.pinned_by, pm.pinned_at, m.username, m.content, m.created_at FROM pinned_messages pm JOIN messages m ON pm.message_id = m.id WHERE pm.channel=:ch ORDER BY pm.pinned_at DESC"), {"ch":channel})
         pinned = []
         for r in res.fetchall():
@@ -288,33 +772,29 @@ async def get_pinned(channel: str):
 
 @app.post("/forward_message")
 async def forward_message(data: ForwardMessageModel):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         # Получаем оригинальное сообщение
         orig = (await session.execute(text("SELECT username, content, created_at FROM messages WHERE id=:id"), {"id":data.message_id})).fetchone()
         if not orig: raise HTTPException(404, "Message not found")
-        now = datetime.now().strftime("%H:%M")
-        # Создаём пересланное сообщение
-        nid = (await session.execute(text("INSERT INTO messages (username, content, channel, created_at, is_edited, reactions, reply_to, read_by, timer, viewed_at, forwarded_from) VALUES (:u, :c, :ch, :t, FALSE, '{}', NULL, '[]', 0, NULL, :fw) RETURNING id"), {"u":data.username, "c":orig[1], "ch":data.target_channel, "t":now, "fw":orig[0]})).scalar()
-        await session.commit()
-        res_u = await session.execute(text("SELECT avatar_url, bio, is_admin FROM users WHERE username=:u"), {"u":data.username})
-        u_row = res_u.fetchone()
-    forwarded_msg = {'id':nid, 'username':data.username, 'content':orig[1], 'channel':data.target_channel, 'created_at':now, 'avatar_url':u_row[0] or "", 'bio':u_row[1] or "", 'is_admin':u_row[2] or False, 'forwarded_from':orig[0], 'is_edited':False, 'reactions':{}, 'read_by':[], 'timer':0}
-    await manager.broadcast(forwarded_msg)
+    # Создаём пересланное сообщение
+    forwarded = await post_messages(data.username, data.target_channel, [{"content": orig[1], "forwarded_from": orig[0]}], kind=None)
+    nid = forwarded[0]['id']
     return {"message": "Forwarded", "message_id": nid}
 
 # --- НОВЫЕ ФУНКЦИИ ---
 
 @app.post("/update_status")
 async def update_status(data: UpdateStatusModel):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         await session.execute(text("UPDATE users SET status=:s, custom_status=:cs WHERE username=:u"), {"s":data.status, "cs":data.custom_status or None, "u":data.username})
         await session.commit()
+    await manager.emit({"op": "invalidate_profile", "username": data.username})
     await manager.broadcast({"type": "status_update", "username": data.username, "status": data.status, "custom_status": data.custom_status})
     return {"message": "Updated"}
 
 @app.post("/update_theme")
 async def update_theme(data: UpdateThemeModel):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         await session.execute(text("UPDATE users SET theme=:t WHERE username=:u"), {"t":data.theme, "u":data.username})
         await session.commit()
     return {"message": "Theme updated", "theme": data.theme}
@@ -322,35 +802,11 @@ async def update_theme(data: UpdateThemeModel):
 @app.get("/get_link_preview")
 async def get_link_preview(url: str):
     """Получает превью ссылки (title, description, image)"""
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=5)) as resp:
-                if resp.status != 200:
-                    return {"error": "Failed to fetch"}
-                html = await resp.text()
-                # Простой парсинг meta тегов
-                title_match = re.search(r'<title>(.*?)</title>', html, re.IGNORECASE | re.DOTALL)
-                og_title = re.search(r'<meta\s+property=["\']og:title["\']\s+content=["\']([^"\']+)["\']', html, re.IGNORECASE)
-                og_desc = re.search(r'<meta\s+property=["\']og:description["\']\s+content=["\']([^"\']+)["\']', html, re.IGNORECASE)
-                og_image = re.search(r'<meta\s+property=["\']og:image["\']\s+content=["\']([^"\']+)["\']', html, re.IGNORECASE)
-                
-                title = (og_title.group(1) if og_title else None) or (title_match.group(1).strip() if title_match else None) or "Ссылка"
-                desc = og_desc.group(1) if og_desc else None
-                image = og_image.group(1) if og_image else None
-                
-                # YouTube специальная обработка
-                if "youtube.com" in url or "youtu.be" in url:
-                    video_id = re.search(r'(?:v=|/)([0-9A-Za-z_-]{11})', url)
-                    if video_id:
-                        image = f"https://img.youtube.com/vi/{video_id.group(1)}/maxresdefault.jpg"
-                
-                return {"title": title[:100], "description": desc[:200] if desc else None, "image": image, "url": url}
-    except Exception as e:
-        return {"error": str(e)}
+    return await link_previews.get_preview(url)
 
 @app.post("/create_voice_channel")
 async def create_voice_channel(data: VoiceChannelModel):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         vid = (await session.execute(text("INSERT INTO voice_channels (name, group_id, created_by) VALUES (:n, :gid, :by) RETURNING id"), {"n":data.name, "gid":data.group_id, "by":data.created_by})).scalar()
         await session.commit()
     await manager.broadcast({"type": "voice_channel_created", "channel_id": vid, "name": data.name, "group_id": data.group_id})
@@ -358,39 +814,32 @@ async def create_voice_channel(data: VoiceChannelModel):
 
 @app.post("/join_voice")
 async def join_voice(data: JoinVoiceModel):
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    async with AsyncSessionLocal() as session:
-        try:
-            await session.execute(text("INSERT INTO voice_channel_members (channel_id, username, joined_at) VALUES (:cid, :u, :at)"), {"cid":data.channel_id, "u":data.username, "at":now})
-            await session.commit()
-        except:
-            pass  # Уже в канале
-    await manager.broadcast({"type": "voice_joined", "channel_id": data.channel_id, "username": data.username})
-    return {"message": "Joined"}
+    # Участники — в памяти (voice.py) и только пока пользователь подключён по websocket
+    if data.username not in manager.online_users(): raise HTTPException(409, "Not connected")
+    async with db_session() as session:
+        row = (await session.execute(text("SELECT group_id FROM voice_channels WHERE id=:cid"), {"cid":data.channel_id})).fetchone()
+    if not row: raise HTTPException(404, "Voice channel not found")
+    await manager.emit(voice.join_event(data.channel_id, data.username, row[0]))
+    return {"message": "Joined", "members": voice.count(data.channel_id)}
 
 @app.post("/leave_voice")
 async def leave_voice(channel_id: int, username: str):
-    async with AsyncSessionLocal() as session:
-        await session.execute(text("DELETE FROM voice_channel_members WHERE channel_id=:cid AND username=:u"), {"cid":channel_id, "u":username})
-        await session.commit()
-    await manager.broadcast({"type": "voice_left", "channel_id": channel_id, "username": username})
-    return {"message": "Left"}
+    await manager.emit(voice.leave_event(username, channel_id))
+    return {"message": "Left", "members": voice.count(channel_id)}
 
 @app.get("/get_voice_channels")
 async def get_voice_channels(group_id: int = None):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         if group_id:
-            res = await session.execute(text("SELECT vc.id, vc.name, vc.group_id, vc.created_by, COUNT(vcm.username) as members FROM voice_channels vc LEFT JOIN voice_channel_members vcm ON vc.id = vcm.channel_id WHERE vc.group_id=:gid GROUP BY vc.id"), {"gid":group_id})
+            res = await session.execute(text("SELECT id, name, group_id, created_by FROM voice_channels WHERE group_id=:gid"), {"gid":group_id})
         else:
-            res = await session.execute(text("SELECT vc.id, vc.name, vc.group_id, vc.created_by, COUNT(vcm.username) as members FROM voice_channels vc LEFT JOIN voice_channel_members vcm ON vc.id = vcm.channel_id GROUP BY vc.id"))
-        channels = []
-        for r in res.fetchall():
-            channels.append({"id": r[0], "name": r[1], "group_id": r[2], "created_by": r[3], "members": r[4]})
-        return channels
+            res = await session.execute(text("SELECT id, name, group_id, created_by FROM voice_channels"))
+        rows = res.fetchall()
+    return [{"id": r[0], "name": r[1], "group_id": r[2], "created_by": r[3], "members": voice.count(r[0]), "users": voice.members_of(r[0])} for r in rows]
 
 @app.get("/search_users")
 async def search_users(query: str):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         res = await session.execute(text("SELECT username, avatar_url, bio FROM users WHERE username LIKE :q LIMIT 10"), {"q": f"%{query}%"})
         users = []
         for r in res.fetchall():
@@ -399,15 +848,15 @@ async def search_users(query: str):
 
 @app.post("/set_message_theme")
 async def set_message_theme(data: MessageThemeModel):
-    async with AsyncSessionLocal() as session:
-        await session.execute(text("UPDATE messages SET message_theme=:t WHERE id=:id"), {"t":data.theme, "id":data.message_id})
+    async with db_session() as session:
+        channel = (await session.execute(text("UPDATE messages SET message_theme=:t WHERE id=:id RETURNING channel"), {"t":data.theme, "id":data.message_id})).scalar()
         await session.commit()
-    await manager.broadcast({"type": "message_theme_changed", "message_id": data.message_id, "theme": data.theme})
+    if channel: await manager.publish(channel, {"type": "message_theme_changed", "message_id": data.message_id, "theme": data.theme})
     return {"message": "Theme set"}
 
 @app.post("/set_role")
 async def set_role(data: SetRoleModel):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         owner = (await session.execute(text("SELECT owner FROM groups WHERE id=:id"), {"id":data.group_id})).scalar()
         if not owner: raise HTTPException(404, "Group not found")
         # Проверяем, что текущий пользователь - владелец (нужно передавать текущего пользователя)
@@ -417,313 +866,245 @@ async def set_role(data: SetRoleModel):
 
 @app.get("/get_activity")
 async def get_activity(username: str, days: int = 7):
-    async with AsyncSessionLocal() as session:
-        res = await session.execute(text("SELECT date, messages_count, reactions_given, reactions_received FROM user_activity WHERE username=:u ORDER BY date DESC LIMIT :d"), {"u":username, "d":days})
-        activity = []
-        for r in res.fetchall():
-            activity.append({"date": r[0], "messages": r[1], "reactions_given": r[2], "reactions_received": r[3]})
-        return activity
+    # Несброшенное с других воркеров — до чтения БД (ask ждёт до 0.5 с), а своё — вместе с ним под блокировкой сброса
+    remote = await manager.ask("activity_pending", {"username": username})
+    async def read():
+        async with db_session() as session:
+            res = await session.execute(text("SELECT date, messages_count, reactions_given, reactions_received FROM user_activity WHERE username=:u ORDER BY date DESC LIMIT :d"), {"u":username, "d":days})
+            return {r[0]: [r[1] or 0, r[2] or 0, r[3] or 0] for r in res.fetchall()}
+    by_date, local = await activity.read_with_pending(username, read)
+    for pending in [local, *remote]:
+        for date, delta in pending.items():
+            counters = by_date.setdefault(date, [0, 0, 0])
+            for i in range(3): counters[i] += delta[i]
+    dates = sorted(by_date, reverse=True)[:days]
+    return [{"date": d, "messages": by_date[d][0], "reactions_given": by_date[d][1], "reactions_received": by_date[d][2]} for d in dates]
 
 @app.post("/update_notification_settings")
 async def update_notification_settings(data: NotificationSettingsModel):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         await session.execute(text("UPDATE users SET notification_settings=:s WHERE username=:u"), {"s":json.dumps(data.settings), "u":data.username})
         await session.commit()
     return {"message": "Updated"}
 
 @app.post("/update_user_id")
 async def update_user_id(data: UserIdUpdateModel):
-    async with AsyncSessionLocal() as session:
-        # Проверяем, не занят ли новый ID
-        existing = (await session.execute(text("SELECT id FROM users WHERE user_id=:uid AND username!=:u"), {"uid":data.new_user_id, "u":data.username})).scalar()
-        if existing:
-            raise HTTPException(400, "Этот ID уже занят")
+    async with db_session() as session:
         # Проверяем формат (6 цифр)
         if not data.new_user_id.isdigit() or len(data.new_user_id) != 6:
             raise HTTPException(400, "ID должен состоять из 6 цифр")
-        await session.execute(text("UPDATE users SET user_id=:uid WHERE username=:u"), {"uid":data.new_user_id, "u":data.username})
-        await session.commit()
+        current = (await session.execute(text("SELECT user_id FROM users WHERE username=:u"), {"u":data.username})).scalar()
+        if current != data.new_user_id:
+            # Проверяем, не занят ли новый ID: из пула его можно забрать только один раз
+            if user_ids.in_pool_range(data.new_user_id): taken = not await user_ids.claim(session, data.new_user_id)
+            else: taken = (await session.execute(text("SELECT id FROM users WHERE user_id=:uid"), {"uid":data.new_user_id})).scalar() is not None
+            if taken:
+                raise HTTPException(400, "Этот ID уже занят")
+            await session.execute(text("UPDATE users SET user_id=:uid WHERE username=:u"), {"uid":data.new_user_id, "u":data.username})
+            await user_ids.release(session, current)
+            await session.commit()
+    # Старый ID мог уйти обратно в пул: его запись в user_id_cache не должна пережить смену
+    await manager.emit({"op": "invalidate_profile", "username": data.username, "old_user_id": current if current != data.new_user_id else None})
     await manager.broadcast({"type": "user_id_updated", "username": data.username, "user_id": data.new_user_id})
     return {"message": "User ID updated", "user_id": data.new_user_id}
 
 @app.post("/upload_sticker")
 async def upload_sticker(data: StickerModel):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        await session.execute(text("INSERT INTO stickers (name, pack_name, sticker_data, created_by, created_at, is_animated) VALUES (:n, :pn, :sd, :cb, :ca, :ia)"), {"n":data.name, "pn":data.pack_name, "sd":data.sticker_data, "cb":data.created_by, "ca":now, "ia":data.is_animated})
+        stored = await stickers.store_image(session, data.sticker_data)
+        # Картинка — в blob store; в sticker_data остаётся только внешняя ссылка, если прислали её
+        blob_sha, mime = stored or (None, None)
+        await session.execute(text("INSERT INTO stickers (name, pack_name, sticker_data, created_by, created_at, is_animated, blob_sha, mime) VALUES (:n, :pn, :sd, :cb, :ca, :ia, :h, :m)"), {"n":data.name, "pn":data.pack_name, "sd":"" if stored else data.sticker_data, "cb":data.created_by, "ca":now, "ia":data.is_animated, "h":blob_sha, "m":mime})
         await session.commit()
-    return {"message": "Sticker uploaded"}
+    await manager.emit({"op": "invalidate_stickers", "pack_name": data.pack_name})
+    return {"message": "Sticker uploaded", "url": f"/blobs/{blob_sha}" if stored else data.sticker_data}
 
 @app.get("/get_stickers")
-async def get_stickers(pack_name: str = None):
-    async with AsyncSessionLocal() as session:
-        if pack_name:
-            res = await session.execute(text("SELECT id, name, sticker_data, is_animated FROM stickers WHERE pack_name=:pn"), {"pn":pack_name})
-        else:
-            res = await session.execute(text("SELECT id, name, sticker_data, is_animated, pack_name FROM stickers"))
-        stickers = []
-        for r in res.fetchall():
-            stickers.append({"id": r[0], "name": r[1], "sticker_data": r[2], "is_animated": r[3] if len(r) > 3 else False, "pack_name": r[4] if len(r) > 4 else None})
-        return stickers
+async def get_stickers(request: Request, pack_name: str = None, limit: int = stickers.STICKER_PAGE_SIZE, cursor: int = None):
+    async with db_session() as session:
+        try:
+            page = await stickers.list_stickers(session, pack_name, limit, cursor)
+        except ValueError:
+            raise HTTPException(400, "Неверный cursor")
+    return stickers.cached_json(request, page)
 
 @app.post("/create_sticker_pack")
 async def create_sticker_pack(data: StickerPackModel):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         await session.execute(text("INSERT INTO sticker_packs (name, title, created_by, created_at, icon) VALUES (:n, :t, :cb, :ca, :i)"), {"n":data.name, "t":data.title, "cb":data.created_by, "ca":now, "i":data.icon or ""})
         await session.commit()
+    await manager.emit({"op": "invalidate_stickers", "pack_name": data.name, "username": "*"})
     return {"message": "Pack created"}
 
 @app.get("/get_sticker_packs")
-async def get_sticker_packs(username: str = None):
-    async with AsyncSessionLocal() as session:
-        if username:
-            # Получаем наборы стикеров пользователя
-            res = await session.execute(text("SELECT sp.id, sp.name, sp.title, sp.icon FROM sticker_packs sp JOIN user_sticker_packs usp ON sp.id = usp.pack_id WHERE usp.username=:u"), {"u":username})
-        else:
-            res = await session.execute(text("SELECT id, name, title, icon FROM sticker_packs"))
-        packs = []
-        for r in res.fetchall():
-            packs.append({"id": r[0], "name": r[1], "title": r[2], "icon": r[3] or ""})
-        return packs
+async def get_sticker_packs(request: Request, username: str = None):
+    async with db_session() as session:
+        packs = await stickers.list_packs(session, username)
+    return stickers.cached_json(request, packs)
 
 @app.post("/add_sticker_pack")
 async def add_sticker_pack(data: AddStickerPackModel):
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         await session.execute(text("INSERT INTO user_sticker_packs (username, pack_id, added_at) VALUES (:u, :pid, :at) ON CONFLICT (username, pack_id) DO NOTHING"), {"u":data.username, "pid":data.pack_id, "at":now})
         await session.commit()
+    await manager.emit({"op": "invalidate_stickers", "username": data.username})
     return {"message": "Pack added"}
 
+async def handle_ws_event(conn: Connection, username: str, data: dict):
+    """Одно событие из websocket; все запросы к БД внутри идут через одну сессию (session_scope)."""
+    if data.get("type") in ["call_offer", "call_answer", "new_ice_candidate", "hang_up"]:
+        target = data.get("target")
+        await manager.send_personal_message(data, target)
+
+    elif data.get("type") == "history":
+        if data.get("before_id") is None and data.get("after_id") is None and data.get("limit") is None:
+            # Старый формат: просто массив последних сообщений
+            async with db_session() as session:
+                history = await load_history(session, data.get("channel"))
+            conn.send(history)
+        else:
+            try:
+                async with db_session() as session:
+                    page = await load_history_page(session, data.get("channel"), data.get("before_id"), data.get("after_id"), data.get("limit"))
+            except ValueError:
+                # Кривой курсор не должен рвать сокет — отвечаем ошибкой только этому устройству
+                conn.send({"type": "error", "request": "history", "message": "Неверные параметры истории"})
+                return
+            page.update({"type": "history_page", "channel": data.get("channel")})
+            conn.send(page)
+
+    elif data.get("type") == "message":
+        content = data['content']
+        # Старые клиенты шлют медиа base64-строкой — сразу убираем его в хранилище
+        if has_inline_data(content):
+            async with db_session() as session:
+                content = await externalize_content(session, content)
+                await session.commit()
+            data['content'] = content
+        
+        # Обновляем статистику активности (сбрасывается в БД пачкой в фоне)
+        activity.record(data['username'], messages=1)
+        
+        # Команды ботов выполняются в фоне (bots.py), ответ придёт отдельным сообщением
+        if bots.dispatch(content, data['channel']):
+            return  # Не обрабатываем команду как обычное сообщение
+        
+        await post_messages(data['username'], data['channel'], [{"content": content, "reply_to": data.get('reply_to'), "timer": data.get('timer', 0), "forwarded_from": data.get('forwarded_from')}])
+
+    elif data.get("type") == "messages":
+        # Пачка сообщений (например, несколько файлов сразу) — один INSERT и один коммит
+        items = [i for i in (data.get("items") or [])[:MAX_MESSAGE_BATCH] if i.get("content")]
+        if items:
+            if any(has_inline_data(i["content"]) for i in items):
+                async with db_session() as session:
+                    for item in items: item["content"] = await externalize_content(session, item["content"])
+                    await session.commit()
+            activity.record(username, messages=len(items))
+            await post_messages(username, data['channel'], items)
+
+    elif data.get("type") == "spy_viewed":
+        async with db_session() as session:
+            view_time = datetime.now().timestamp()
+            row = (await session.execute(text("UPDATE messages SET viewed_at=:vt WHERE id=:id AND viewed_at IS NULL RETURNING channel, timer"), {"vt":str(view_time), "id":data.get("message_id")})).fetchone()
+            await session.commit()
+            if row:
+                # Сервер сам удалит сообщение, когда таймер истечёт
+                if row[1]: spy_expiry.schedule(data.get("message_id"), view_time + row[1])
+                await manager.publish(row[0], {"type": "spy_start", "message_id": data.get("message_id"), "start_time": view_time})
+
+    elif data.get("type") == "mark_read":
+        async with db_session() as session:
+            mid = data.get("message_id")
+            # Двигаем отметку "прочитано до" только вперёд; строка вернётся, если она сдвинулась
+            row = (await session.execute(text(READ_WATERMARK_SQL), {"id":mid, "u":username})).fetchone()
+            await session.commit()
+        if row:
+            await manager.publish(row[0], {"type": "read_update", "channel": row[0], "username": username, "message_id": mid, "last_read_id": row[1]})
+
+    elif data.get("type") == "reaction":
+        async with db_session() as session:
+            mid = data.get("message_id")
+            emoji = data.get("emoji")
+            row = (await session.execute(text(TOGGLE_REACTION_SQL), {"id":mid, "u":username, "e":emoji})).fetchone()
+            if row:
+                msg_author, channel, was_added = row
+                
+                # Обновляем статистику реакций
+                if was_added:
+                    activity.record(username, reactions_given=1)
+                    if msg_author != username: activity.record(msg_author, reactions_received=1)
+                counts = await reaction_counts(session, mid)
+                event = {"type": "reaction_update", "message_id": mid, "channel": channel, "reactions": counts}
+                await event_log.append(session, channel, [event])
+                await session.commit()
+                await manager.publish(channel, event)
+
+    elif data.get("type") == "edit_message":
+        async with db_session() as session:
+            msg = (await session.execute(text("SELECT username, channel FROM messages WHERE id=:id"), {"id":data.get("message_id")})).fetchone()
+            is_admin = await profiles.is_admin(session, username)
+            if msg and (msg[0] == username or is_admin):
+                await session.execute(text("UPDATE messages SET content=:c, is_edited=TRUE WHERE id=:id"), {"c":data.get("new_content"), "id":data.get("message_id")})
+                event = {"type": "edit_update", "message_id": data.get("message_id"), "channel": msg[1], "new_content": data.get("new_content")}
+                await event_log.append(session, msg[1], [event])
+                await session.commit()
+                await manager.publish(msg[1], event)
+
+    elif data.get("type") == "delete":
+        async with db_session() as session:
+            is_admin = await profiles.is_admin(session, username)
+            res_m = await session.execute(text("SELECT username, channel FROM messages WHERE id=:id"), {"id":data.get("message_id")})
+            msg_row = res_m.fetchone()
+            if msg_row and (is_admin or msg_row[0] == username):
+                await session.execute(text("DELETE FROM messages WHERE id=:id"), {"id":data.get("message_id")})
+                await session.execute(text("DELETE FROM message_reactions WHERE message_id=:id"), {"id":data.get("message_id")})
+                event = {"type": "delete", "message_id": data.get("message_id"), "channel": msg_row[1]}
+                await event_log.forget_message(session, msg_row[1], data.get("message_id"))
+                await event_log.append(session, msg_row[1], [event])
+                await session.commit()
+                await manager.publish(msg_row[1], event)
+
+    elif data.get("type") == "sync":
+        # Догоняем канал после переподключения: только события после since
+        channel = data.get("channel")
+        if channel in manager.user_channels.get(username, ()):
+            async with db_session() as session:
+                result = await event_log.events_since(session, channel, data.get("since"), data.get("limit"))
+            result.update({"type": "sync", "channel": channel})
+            conn.send(result)
+
+    elif data.get("type") == "typing":
+        # Только в свои каналы и не чаще TYPING_INTERVAL на пользователя и канал
+        channel = data.get("channel")
+        if channel in manager.user_channels.get(username, ()):
+            await presence.typing(username, channel)
+    elif data.get("type") == "ban_user":
+        async with db_session() as session:
+            if await profiles.is_admin(session, username):
+                t = data.get("target")
+                # Здесь только быстрая часть; сообщения и реакции удалит фоновая задача
+                job_id = await purge.submit(session, t, username)
+                await session.commit()
+                purge.run(job_id)
+                await manager.emit({"op": "invalidate_profile", "username": t})
+                await manager.kick_user(t)
+                await manager.broadcast({"type": "system", "content": f"Пользователь {t} был забанен!"})
+
 @app.websocket("/ws/{username}")
 async def websocket_endpoint(websocket: WebSocket, username: str):
-    await manager.connect(websocket, username)
+    conn = await manager.connect(websocket, username)
     try:
         while True:
             raw_data = await websocket.receive_text()
             data = json.loads(raw_data)
-            
-            if data.get("type") in ["call_offer", "call_answer", "new_ice_candidate", "hang_up"]:
-                target = data.get("target")
-                await manager.send_personal_message(data, target)
-
-            elif data.get("type") == "history":
-                async with AsyncSessionLocal() as session:
-                    res = await session.execute(text("SELECT m.id, m.username, m.content, m.channel, m.created_at, u.avatar_url, u.bio, u.is_admin, m.is_edited, m.reactions, m.reply_to, m.read_by, m.timer, m.viewed_at, m.mentions, m.forwarded_from, m.is_pinned, m.link_preview FROM messages m LEFT JOIN users u ON m.username = u.username WHERE m.channel=:ch ORDER BY m.id DESC LIMIT 50"), {"ch":data.get("channel")})
-                    history = []
-                    for r in res.fetchall():
-                        reply_content = None
-                        if r[10]: 
-                            res_p = await session.execute(text("SELECT username, content FROM messages WHERE id=:pid"), {"pid":r[10]})
-                            parent = res_p.fetchone()
-                            if parent: reply_content = {"username": parent[0], "content": parent[1]}
-                        mentions_list = json.loads(r[14]) if r[14] else []
-                        link_preview_obj = json.loads(r[17]) if r[17] else None
-                        message_theme = r[18] if len(r) > 18 else None
-                        # Получаем user_id автора сообщения
-                        user_id_res = await session.execute(text("SELECT user_id FROM users WHERE username=:u"), {"u":r[1]})
-                        user_id_row = user_id_res.fetchone()
-                        author_user_id = user_id_row[0] if user_id_row and user_id_row[0] else None
-                        history.append({"id": r[0], "username": r[1], "content": r[2], "channel": r[3], "created_at": r[4], "avatar_url": r[5], "bio": r[6], "is_admin": r[7], "is_edited": r[8] if len(r) > 8 else False, "reactions": json.loads(r[9]) if r[9] else {}, "reply_to": r[10], "reply_preview": reply_content, "read_by": json.loads(r[11]) if r[11] else [], "timer": r[12] or 0, "viewed_at": r[13], "mentions": mentions_list, "forwarded_from": r[15] or None, "is_pinned": r[16] or False, "link_preview": link_preview_obj, "message_theme": message_theme, "user_id": author_user_id})
-                    await websocket.send_text(json.dumps(history))
-
-            elif data.get("type") == "message":
-                now = datetime.now().strftime("%H:%M")
-                content = data['content']
-                
-                # Обновляем статистику активности
-                today = datetime.now().strftime("%Y-%m-%d")
-                try:
-                    async with AsyncSessionLocal() as temp_session:
-                        await temp_session.execute(text("INSERT INTO user_activity (username, date, messages_count) VALUES (:u, :d, 1) ON CONFLICT (username, date) DO UPDATE SET messages_count = user_activity.messages_count + 1"), {"u":data['username'], "d":today})
-                        await temp_session.commit()
-                except Exception as e:
-                    print(f"Activity update error: {e}")
-                    pass
-                
-                # Обработка команд ботов
-                if content.startswith('/'):
-                    cmd_parts = content.split(' ', 1)
-                    cmd = cmd_parts[0].lower()
-                    args = cmd_parts[1] if len(cmd_parts) > 1 else ""
-                    
-                    bot_response = None
-                    if cmd == '/gif':
-                        # Используем Giphy API (можно заменить на свой ключ)
-                        try:
-                            async with aiohttp.ClientSession() as sess:
-                                async with sess.get(f"https://api.giphy.com/v1/gifs/random?api_key=dc6zaTOxFJmzC&tag={args or 'funny'}") as resp:
-                                    gif_data = await resp.json()
-                                    if gif_data.get('data', {}).get('images', {}).get('original', {}).get('url'):
-                                        bot_response = f"🎬 {gif_data['data']['images']['original']['url']}"
-                        except:
-                            bot_response = "❌ Ошибка загрузки GIF"
-                    
-                    elif cmd == '/weather':
-                        if not args:
-                            bot_response = "🌤️ Использование: /weather <город>"
-                        else:
-                            try:
-                                async with aiohttp.ClientSession() as sess:
-                                    async with sess.get(f"http://wttr.in/{args}?format=3") as resp:
-                                        weather = await resp.text()
-                                        bot_response = f"🌡️ {weather.strip()}"
-                            except:
-                                bot_response = f"❌ Не удалось получить погоду для {args}"
-                    
-                    elif cmd == '/joke':
-                        jokes = [
-                            "Почему программисты не любят природу? Там слишком много багов!",
-                            "Что говорит один байт другому? Мы встретимся на мегабайте!",
-                            "Почему Python не может летать? Потому что это змея!",
-                            "Как называется программист, который не пьет кофе? Сонный.",
-                            "Почему JavaScript разработчики носят очки? Потому что не могут C#!"
-                        ]
-                        import random
-                        bot_response = f"😄 {random.choice(jokes)}"
-                    
-                    elif cmd == '/help':
-                        bot_response = """📋 Доступные команды:
-/gif [тег] - случайный GIF
-/weather [город] - погода
-/joke - случайная шутка
-/help - эта справка"""
-                    
-                    if bot_response:
-                        # Отправляем ответ бота как сообщение
-                        async with AsyncSessionLocal() as session:
-                            nid = (await session.execute(text("INSERT INTO messages (username, content, channel, created_at, is_edited, reactions, reply_to, read_by, timer, viewed_at, mentions) VALUES (:u, :c, :ch, :t, FALSE, '{}', NULL, '[]', 0, NULL, '[]') RETURNING id"), {"u":"🤖 Bot", "c":bot_response, "ch":data['channel'], "t":now})).scalar()
-                            await session.commit()
-                            res_u = await session.execute(text("SELECT avatar_url, bio, is_admin FROM users WHERE username=:u"), {"u":"🤖 Bot"})
-                            u_row = res_u.fetchone() or ("", "Бот", False)
-                        bot_msg = {'id':nid, 'username':"🤖 Bot", 'content':bot_response, 'channel':data['channel'], 'created_at':now, 'avatar_url':"", 'bio':"Бот", 'is_admin':False, 'is_edited':False, 'reactions':{}, 'read_by':[], 'timer':0, 'mentions':[]}
-                        await manager.broadcast(bot_msg)
-                        continue  # Не обрабатываем команду как обычное сообщение
-                
-                # Парсим упоминания @username из текста
-                mentions = re.findall(r'@(\w+)', content)
-                mentions_json = json.dumps(list(set(mentions)))  # Убираем дубликаты
-                
-                # Парсим ссылки для превью
-                link_preview = None
-                url_pattern = re.compile(r'https?://[^\s]+')
-                urls = url_pattern.findall(content)
-                if urls:
-                    try:
-                        preview = await get_link_preview(urls[0])
-                        if preview.get('title'):
-                            link_preview = json.dumps(preview)
-                    except:
-                        pass
-                
-                async with AsyncSessionLocal() as session:
-                    nid = (await session.execute(text("INSERT INTO messages (username, content, channel, created_at, is_edited, reactions, reply_to, read_by, timer, viewed_at, mentions, forwarded_from, link_preview) VALUES (:u, :c, :ch, :t, FALSE, '{}', :rep, '[]', :tim, NULL, :ment, :fw, :lp) RETURNING id"), {"u":data['username'], "c":content, "ch":data['channel'], "t":now, "rep":data.get('reply_to'), "tim":data.get('timer', 0), "ment":mentions_json, "fw":data.get('forwarded_from'), "lp":link_preview})).scalar()
-                    await session.commit()
-                    res_u = await session.execute(text("SELECT avatar_url, bio, is_admin FROM users WHERE username=:u"), {"u":data['username']})
-                    u_row = res_u.fetchone()
-                    reply_content = None
-                    if data.get('reply_to'):
-                        res_p = await session.execute(text("SELECT username, content FROM messages WHERE id=:pid"), {"pid":data.get('reply_to')})
-                        parent = res_p.fetchone()
-                        if parent: reply_content = {"username": parent[0], "content": parent[1]}
-                    
-                    # Отправляем уведомления упомянутым пользователям
-                    for mentioned_user in mentions:
-                        if mentioned_user != data['username']:  # Не упоминаем себя
-                            await manager.send_personal_message({
-                                "type": "mention",
-                                "message_id": nid,
-                                "channel": data['channel'],
-                                "from": data['username'],
-                                "content": data['content'][:50] + "..." if len(data['content']) > 50 else data['content']
-                            }, mentioned_user)
-                
-                link_preview_obj = json.loads(link_preview) if link_preview else None
-                data.update({'id':nid, 'created_at':now, 'avatar_url':u_row[0] or "", 'bio':u_row[1] or "", 'is_admin':u_row[2] or False, 'is_edited': False, 'reactions': {}, 'reply_to': data.get('reply_to'), 'reply_preview': reply_content, 'read_by': [], 'timer': data.get('timer', 0), 'viewed_at': None, 'mentions': mentions, 'link_preview': link_preview_obj})
-                await manager.broadcast(data)
-
-            elif data.get("type") == "spy_viewed":
-                async with AsyncSessionLocal() as session:
-                    view_time = datetime.now().timestamp()
-                    await session.execute(text("UPDATE messages SET viewed_at=:vt WHERE id=:id AND viewed_at IS NULL"), {"vt":str(view_time), "id":data.get("message_id")})
-                    await session.commit()
-                    await manager.broadcast({"type": "spy_start", "message_id": data.get("message_id"), "start_time": view_time})
-
-            elif data.get("type") == "mark_read":
-                async with AsyncSessionLocal() as session:
-                    mid = data.get("message_id")
-                    res = await session.execute(text("SELECT read_by FROM messages WHERE id=:id"), {"id":mid})
-                    row = res.fetchone()
-                    if row:
-                        readers = json.loads(row[0]) if row[0] else []
-                        if username not in readers:
-                            readers.append(username)
-                            await session.execute(text("UPDATE messages SET read_by=:r WHERE id=:id"), {"r":json.dumps(readers), "id":mid})
-                            await session.commit()
-                            await manager.broadcast({"type": "read_update", "message_id": mid, "readers": readers})
-
-            elif data.get("type") == "reaction":
-                async with AsyncSessionLocal() as session:
-                    mid = data.get("message_id")
-                    emoji = data.get("emoji")
-                    res = await session.execute(text("SELECT reactions, username FROM messages WHERE id=:id"), {"id":mid})
-                    row = res.fetchone()
-                    if row:
-                        current = json.loads(row[0]) if row[0] else {}
-                        msg_author = row[1]
-                        was_added = username not in (current.get(emoji) or [])
-                        if emoji not in current: current[emoji] = []
-                        if username in current[emoji]: current[emoji].remove(username); 
-                        else: current[emoji].append(username)
-                        if not current[emoji]: del current[emoji]
-                        await session.execute(text("UPDATE messages SET reactions=:r WHERE id=:id"), {"r":json.dumps(current), "id":mid})
-                        
-                        # Обновляем статистику реакций
-                        today = datetime.now().strftime("%Y-%m-%d")
-                        try:
-                            if was_added:
-                                await session.execute(text("INSERT INTO user_activity (username, date, reactions_given) VALUES (:u, :d, 1) ON CONFLICT (username, date) DO UPDATE SET reactions_given = user_activity.reactions_given + 1"), {"u":username, "d":today})
-                                if msg_author != username:
-                                    await session.execute(text("INSERT INTO user_activity (username, date, reactions_received) VALUES (:u, :d, 1) ON CONFLICT (username, date) DO UPDATE SET reactions_received = user_activity.reactions_received + 1"), {"u":msg_author, "d":today})
-                        except Exception as e:
-                            print(f"Reaction activity update error: {e}")
-                            pass
-                        
-                        await session.commit()
-                        await manager.broadcast({"type": "reaction_update", "message_id": mid, "reactions": current})
-
-            elif data.get("type") == "edit_message":
-                async with AsyncSessionLocal() as session:
-                    msg = (await session.execute(text("SELECT username FROM messages WHERE id=:id"), {"id":data.get("message_id")})).fetchone()
-                    is_admin = (await session.execute(text("SELECT is_admin FROM users WHERE username=:u"), {"u":username})).scalar()
-                    if msg and (msg[0] == username or is_admin):
-                        await session.execute(text("UPDATE messages SET content=:c, is_edited=TRUE WHERE id=:id"), {"c":data.get("new_content"), "id":data.get("message_id")})
-                        await session.commit()
-                        await manager.broadcast({"type": "edit_update", "message_id": data.get("message_id"), "new_content": data.get("new_content")})
-
-            elif data.get("type") == "delete":
-                async with AsyncSessionLocal() as session:
-                    res_a = await session.execute(text("SELECT is_admin FROM users WHERE username=:u"), {"u":username})
-                    is_admin = res_a.scalar()
-                    res_m = await session.execute(text("SELECT username FROM messages WHERE id=:id"), {"id":data.get("message_id")})
-                    msg_author = res_m.scalar()
-                    if is_admin or msg_author == username:
-                        await session.execute(text("DELETE FROM messages WHERE id=:id"), {"id":data.get("message_id")})
-                        await session.commit()
-                        await manager.broadcast(data)
-
-            elif data.get("type") == "typing": await manager.broadcast(data)
-            elif data.get("type") == "ban_user":
-                async with AsyncSessionLocal() as session:
-                    res = await session.execute(text("SELECT is_admin FROM users WHERE username=:u"), {"u":username})
-                    if res.scalar():
-                        t = data.get("target")
-                        for q in ["DELETE FROM users WHERE username=:t", "DELETE FROM messages WHERE username=:t", "DELETE FROM messages WHERE channel LIKE :p", "DELETE FROM dms WHERE user1=:t OR user2=:t", "DELETE FROM group_members WHERE username=:t"]:
-                            await session.execute(text(q), {"t":t, "p":f"%_{t}%"})
-                        await session.commit()
-                        await manager.kick_user(t)
-                        await manager.broadcast({"type": "system", "content": f"Пользователь {t} был забанен!"})
+            async with session_scope():
+                await handle_ws_event(conn, username, data)
 
     except WebSocketDisconnect:
-        manager.disconnect(username)
-        await manager.broadcast({"type": "status", "username": username, "status": "offline"})
\ No newline at end of file
+        pass
+    finally:
+        # Любой выход из цикла снимает именно это устройство, иначе оно «висело» бы онлайн
+        if manager.disconnect(conn): await manager.went_offline(username)
\ No newline at end of file
@@ -0,0 +1,132 @@
+"""
+Очередь исходящих сообщений одного сокета.
+
+Рассылка только кладёт готовый кадр (str или bytes) в ограниченную очередь соединения, а
+отправляет его отдельная задача-писатель. Медленный клиент больше не тормозит
+остальных: его очередь копится сама по себе, эфемерные события (typing)
+схлопываются до последнего или выбрасываются, а клиента, который не успевает
+дольше SLOW_CONSUMER_SECONDS, отключаем. Остальные события (сообщения,
+правки, удаления) не выбрасываются никогда: если такому нет места, клиента
+отключаем сразу — после переподключения он догонит канал по seq, а не
+останется молча с дырой.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", "256"))
+SEND_TIMEOUT = float(os.getenv("SEND_TIMEOUT", "5"))
+SLOW_CONSUMER_SECONDS = float(os.getenv("SLOW_CONSUMER_SECONDS", "10"))
+
+# type события -> (поля ключа схлопывания, можно ли выбросить при полной очереди).
+# Из нескольких ждущих событий с одинаковым ключом клиенту уйдёт только последнее.
+POLICIES = {
+    "typing": (("channel", "username"), True),
+}
+
+counters = {"sent": 0, "dropped": 0, "coalesced": 0, "evicted": 0}
+
+
+def policy_for(data: dict):
+    """(ключ схлопывания или None, можно ли выбросить) для события."""
+    kind = data.get("type") if isinstance(data, dict) else None
+    policy = POLICIES.get(kind)
+    if policy is None:
+        return None, False
+    fields, droppable = policy
+    return (kind, *(data.get(f) for f in fields)), droppable
+
+
+class Outbox:
+    __slots__ = ("websocket", "queue", "pending", "wakeup", "writer", "full_since", "closed")
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        # Элементы очереди — [payload, ключ]; pending: ключ -> элемент, ещё не отправленный
+        self.queue: deque = deque()
+        self.pending: dict = {}
+        self.wakeup = asyncio.Event()
+        self.writer: asyncio.Task = None
+        self.full_since: float = None
+        self.closed = False
+
+    def start(self):
+        self.writer = asyncio.create_task(self._run())
+
+    def put(self, payload: str, key=None, droppable: bool = False) -> bool:
+        if self.closed:
+            return False
+        entry = self.pending.get(key) if key is not None else None
+        if entry is not None:
+            entry[0] = payload
+            counters["coalesced"] += 1
+            return True
+        if len(self.queue) >= SEND_QUEUE_SIZE:
+            if not droppable:
+                asyncio.create_task(self.evict())
+                return False
+            counters["dropped"] += 1
+            now = time.monotonic()
+            if self.full_since is None:
+                self.full_since = now
+            elif now - self.full_since > SLOW_CONSUMER_SECONDS:
+                asyncio.create_task(self.evict())
+            return False
+        entry = [payload, key]
+        self.queue.append(entry)
+        if key is not None:
+            self.pending[key] = entry
+        self.wakeup.set()
+        return True
+
+    def __len__(self):
+        return len(self.queue)
+
+    async def _run(self):
+        try:
+            while True:
+                while not self.queue:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                payload, key = self.queue.popleft()
+                if key is not None:
+                    self.pending.pop(key, None)
+                self.full_since = None
+                send = self.websocket.send_bytes if isinstance(payload, bytes) else self.websocket.send_text
+                await asyncio.wait_for(send(payload), SEND_TIMEOUT)
+                counters["sent"] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Не смогли отправить за SEND_TIMEOUT или сокет уже мёртв
+            await self.evict()
+
+    def close(self):
+        """Останавливает писателя; неотправленное выбрасывается."""
+        self.closed = True
+        if self.writer and self.writer is not asyncio.current_task():
+            self.writer.cancel()
+        self.queue.clear()
+        self.pending.clear()
+
+    async def evict(self):
+        """Отключает медленного клиента; дальше его подчистит обработчик сокета."""
+        if self.closed:
+            return
+        counters["evicted"] += 1
+        self.close()
+        try:
+            await self.websocket.close(code=1013)
+        except Exception:
+            pass
+
+
+def stats(outboxes) -> dict:
+    depths = [len(o) for o in outboxes]
+    return {
+        **counters,
+        "queued": sum(depths),
+        "max_depth": max(depths, default=0),
+        "queue_size": SEND_QUEUE_SIZE,
+    }
@@ -0,0 +1,95 @@
+"""
+Хэширование паролей (Argon2) вне цикла событий.
+
+Argon2 специально тяжёлый по CPU и памяти: посчитанный прямо в async-обработчике,
+он на десятки миллисекунд замораживает все websocket'ы. Поэтому hash/verify
+идут в отдельный пул из HASH_WORKERS потоков (argon2-cffi отпускает GIL).
+Одновременно в работе и в очереди — не больше HASH_WORKERS + HASH_QUEUE_LIMIT
+операций; лишние сразу получают HashingBusy (обработчик отвечает 503), чтобы
+всплеск логинов после деплоя не копил бесконечную очередь.
+Цена Argon2 настраивается через ARGON2_*; хэши со старыми параметрами
+пересчитываются при следующем успешном входе.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from passlib.context import CryptContext
+
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", "64"))
+# По умолчанию — параметры passlib, с которыми уже посчитаны существующие хэши
+ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", "2"))
+ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", "102400"))  # KiB
+ARGON2_PARALLELISM = int(os.getenv("ARGON2_PARALLELISM", "8"))
+
+pwd_context = CryptContext(
+    schemes=["argon2"],
+    deprecated="auto",
+    argon2__time_cost=ARGON2_TIME_COST,
+    argon2__memory_cost=ARGON2_MEMORY_COST,
+    argon2__parallelism=ARGON2_PARALLELISM,
+)
+
+_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="argon2")
+_in_flight = 0
+counters = {"hashed": 0, "verified": 0, "rehashed": 0, "rejected": 0, "busy_seconds": 0.0}
+
+
+class HashingBusy(Exception):
+    pass
+
+
+def _verify_and_update(plain: str, hashed: str):
+    try:
+        return pwd_context.verify_and_update(plain, hashed)
+    except (ValueError, TypeError):
+        # Битый или не-argon2 хэш в базе — просто неверный пароль
+        return False, None
+
+
+def _release(started: float):
+    global _in_flight
+    _in_flight -= 1
+    counters["busy_seconds"] += time.perf_counter() - started
+
+
+async def _submit(fn, *args):
+    global _in_flight
+    if _in_flight >= HASH_WORKERS + HASH_QUEUE_LIMIT:
+        counters["rejected"] += 1
+        raise HashingBusy()
+    _in_flight += 1
+    started = time.perf_counter()
+    future = asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+    # Слот освобождает сама задача пула: если клиент отключился и корутину отменили,
+    # поток всё равно досчитывает хэш и до этого занимает место
+    future.add_done_callback(lambda _: _release(started))
+    return await asyncio.shield(future)
+
+
+async def hash_password(password: str) -> str:
+    result = await _submit(pwd_context.hash, password)
+    counters["hashed"] += 1
+    return result
+
+
+async def verify_password(plain: str, hashed: str) -> tuple[bool, str]:
+    """(верен ли пароль, новый хэш или None) — новый хэш, если параметры Argon2 поменялись."""
+    ok, new_hash = await _submit(_verify_and_update, plain, hashed)
+    counters["verified"] += 1
+    if new_hash:
+        counters["rehashed"] += 1
+    return ok, new_hash
+
+
+def stats() -> dict:
+    done = counters["hashed"] + counters["verified"]
+    return {
+        **{k: v for k, v in counters.items() if k != "busy_seconds"},
+        "in_flight": _in_flight,
+        "workers": HASH_WORKERS,
+        "queue_limit": HASH_QUEUE_LIMIT,
+        "avg_ms": round(counters["busy_seconds"] / done * 1000, 2) if done else 0.0,
+    }
@@ -0,0 +1,118 @@
+"""
+Присутствие и «печатает…» без лавины служебных событий.
+
+Смены online/offline не рассылаются по одной: они копятся и раз в
+PRESENCE_FLUSH_INTERVAL секунд уходят кадрами
+{"type": "presence", "online": [...], "offline": [...]} — каждому получателю
+свой кадр и только со статусами его контактов (личка или общая группа), а не
+всем подряд. События typing от одного пользователя в одном канале уходят не
+чаще раза в TYPING_INTERVAL: первое — сразу, а если за окно пришли ещё,
+последнее досылается в конце окна, чтобы индикатор не погас раньше времени.
+"""
+import asyncio
+import os
+import time
+
+PRESENCE_FLUSH_INTERVAL = float(os.getenv("PRESENCE_FLUSH_INTERVAL", "1"))
+TYPING_INTERVAL = float(os.getenv("TYPING_INTERVAL", "1.5"))
+
+
+class PresenceService:
+    def __init__(self, interval: float = PRESENCE_FLUSH_INTERVAL, typing_interval: float = TYPING_INTERVAL):
+        self.interval = interval
+        self.typing_interval = typing_interval
+        # username -> последний статус за окно; промежуточные смены не нужны
+        self.changes: dict[str, str] = {}
+        # (username, channel) -> когда последний раз пропустили typing
+        self.typing_seen: dict[tuple[str, str], float] = {}
+        # (username, channel) -> отложенная досылка typing в конце окна
+        self.typing_trailing: dict[tuple[str, str], asyncio.TimerHandle] = {}
+        self.counters = {"frames": 0, "changes": 0, "typing_forwarded": 0, "typing_suppressed": 0, "typing_trailing": 0}
+        self._recipients = None
+        self._send = None
+        self._publish = None
+        self._tasks: set = set()
+        self._task: asyncio.Task = None
+
+    def set_status(self, username: str, status: str):
+        self.changes[username] = status
+        self.counters["changes"] += 1
+
+    def allow_typing(self, username: str, channel: str) -> bool:
+        """True — отправить сейчас; иначе событие отложено до конца окна (одно на окно)."""
+        now = time.monotonic()
+        key = (username, channel)
+        last = self.typing_seen.get(key)
+        if last is not None and now - last < self.typing_interval:
+            self.counters["typing_suppressed"] += 1
+            if key not in self.typing_trailing:
+                delay = last + self.typing_interval - now
+                self.typing_trailing[key] = asyncio.get_running_loop().call_later(delay, self._fire_trailing, key)
+            return False
+        self.typing_seen[key] = now
+        self.counters["typing_forwarded"] += 1
+        return True
+
+    async def typing(self, username: str, channel: str):
+        if self.allow_typing(username, channel):
+            await self._publish(channel, {"type": "typing", "channel": channel, "username": username})
+
+    def _fire_trailing(self, key: tuple[str, str]):
+        self.typing_trailing.pop(key, None)
+        # Досылка открывает новое окно: следующие события в нём снова копятся
+        self.typing_seen[key] = time.monotonic()
+        self.counters["typing_trailing"] += 1
+        username, channel = key
+        task = asyncio.create_task(self._publish(channel, {"type": "typing", "channel": channel, "username": username}))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        # Старые отметки typing больше ничего не подавляют — не держим их в памяти
+        deadline = time.monotonic() - self.typing_interval
+        self.typing_seen = {k: t for k, t in self.typing_seen.items() if t > deadline or k in self.typing_trailing}
+        if not self.changes:
+            return
+        batch, self.changes = self.changes, {}
+        try:
+            recipients = await self._recipients(list(batch))
+            frames = {}
+            for username, status in batch.items():
+                for recipient in recipients.get(username, ()):
+                    frame = frames.setdefault(recipient, {"type": "presence", "online": [], "offline": []})
+                    frame[status].append(username)
+            if frames:
+                self.counters["frames"] += len(frames)
+                await self._send(frames)
+        except Exception as e:
+            print(f"Presence flush error: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self, recipients, send, publish):
+        """
+        recipients(usernames) -> {username: кому показывать его статус} (онлайн-контакты);
+        send({получатель: кадр}) — личные кадры; publish(channel, event) — typing в канал.
+        """
+        self._recipients = recipients
+        self._send = send
+        self._publish = publish
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        for handle in self.typing_trailing.values():
+            handle.cancel()
+        self.typing_trailing.clear()
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {**self.counters, "pending": len(self.changes), "typing_tracked": len(self.typing_seen)}
+
+
+presence = PresenceService()
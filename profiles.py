@@ -0,0 +1,72 @@
+"""
+Процессный кэш профилей пользователей.
+
+Профиль (то, что отдаёт /get_profile) и флаг is_admin читаются на каждое
+открытие профиля, правку, удаление и бан. Держим их в LRU/TTL-кэше и
+сбрасываем запись при update_profile, update_user_id, update_status и бане.
+"""
+import os
+
+from sqlalchemy import text
+
+from cache import TTLCache
+
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "300"))
+
+PROFILE_SQL = "SELECT username, bio, avatar_url, is_admin, real_name, location, birth_date, social_link, wallpaper, user_id, phone, email FROM users WHERE {key}=:v"
+
+profile_cache = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+# user_id -> username, чтобы поиск по ID тоже попадал в кэш
+user_id_cache = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+
+
+def _row_to_profile(row) -> dict:
+    return {"username": row[0], "bio": row[1], "avatar_url": row[2], "is_admin": row[3], "real_name": row[4] or "", "location": row[5] or "", "birth_date": row[6] or "", "social_link": row[7] or "", "wallpaper": row[8] or "", "user_id": row[9] or "", "phone": row[10] or "", "email": row[11] or ""}
+
+
+async def get_profile(session, username: str = None, user_id: str = None):
+    """Профиль по нику или 6-значному ID; None, если пользователя нет."""
+    if user_id:
+        username = user_id_cache.get(user_id) or username
+        cached = profile_cache.get(username) if username else None
+        if cached is None or cached["user_id"] != user_id:
+            row = (await session.execute(text(PROFILE_SQL.format(key="user_id")), {"v": user_id})).fetchone()
+            if not row:
+                return None
+            profile = _row_to_profile(row)
+            remember(profile)
+            return profile
+        return cached
+    profile = profile_cache.get(username)
+    if profile is None:
+        row = (await session.execute(text(PROFILE_SQL.format(key="username")), {"v": username})).fetchone()
+        if not row:
+            return None
+        profile = _row_to_profile(row)
+        remember(profile)
+    return profile
+
+
+async def is_admin(session, username: str) -> bool:
+    profile = await get_profile(session, username)
+    return bool(profile and profile["is_admin"])
+
+
+def remember(profile: dict):
+    profile_cache.set(profile["username"], profile)
+    if profile["user_id"]:
+        user_id_cache.set(profile["user_id"], profile["username"])
+
+
+def invalidate(username: str, old_user_id: str = None):
+    """old_user_id — освобождённый ID: его запись сбрасываем, даже если профиля нет в кэше."""
+    profile = profile_cache.pop(username)
+    if profile and profile["user_id"]:
+        user_id_cache.pop(profile["user_id"])
+    if old_user_id:
+        user_id_cache.pop(old_user_id)
+
+
+def stats() -> dict:
+    return {"profiles": profile_cache.stats(), "user_ids": user_id_cache.stats()}
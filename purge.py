@@ -0,0 +1,215 @@
+"""
+Фоновое удаление данных забаненного пользователя.
+
+Бан сам по себе быстрый: в транзакции обработчика удаляются пользователь,
+его лички, членство в группах и отметки прочтения, а точный список
+затронутых личек (из dms, а не LIKE по имени канала) сохраняется в
+purge_jobs. Сообщения и реакции затем удаляет фоновая задача порциями по
+PURGE_CHUNK строк, чтобы блокировки были короткими. После каждой порции
+шаг и счётчик пишутся в purge_jobs в той же транзакции, поэтому после
+падения задача продолжается с того же места. Прогресс уходит
+забанившему админу событиями purge_progress.
+"""
+import asyncio
+import json
+import os
+import time
+
+from sqlalchemy import text
+
+from database import AsyncSessionLocal
+
+PURGE_CHUNK = int(os.getenv("PURGE_CHUNK", "1000"))
+# Задача, которая не отчитывалась дольше этого, считается брошенной и подхватывается заново
+PURGE_STALE_SECONDS = 60
+
+# Без SKIP LOCKED: пустая порция переводит задачу на следующий шаг, и строки, на миг
+# занятые чужой правкой или реакцией, так и остались бы неудалёнными. Задача по цели одна
+# (см. CLAIM_SQL), так что ждём освобождения строк, а не обходим их.
+DM_MESSAGES_SQL = """
+    WITH batch AS (
+        SELECT id FROM messages WHERE channel = ANY(CAST(:chs AS text[])) ORDER BY channel, id LIMIT :n FOR UPDATE
+    )
+    DELETE FROM messages m USING batch WHERE m.id = batch.id RETURNING m.id, m.channel
+"""
+USER_MESSAGES_SQL = """
+    WITH batch AS (
+        SELECT id FROM messages WHERE username = :t ORDER BY id LIMIT :n FOR UPDATE
+    )
+    DELETE FROM messages m USING batch WHERE m.id = batch.id RETURNING m.id, m.channel
+"""
+REACTIONS_SQL = """
+    DELETE FROM message_reactions WHERE ctid = ANY(ARRAY(
+        SELECT ctid FROM message_reactions WHERE username = :t LIMIT :n
+    ))
+"""
+CLAIM_SQL = """
+    UPDATE purge_jobs SET updated_at = now()
+    WHERE state = 'running' AND updated_at < now() - make_interval(secs => :s)
+    RETURNING id
+"""
+
+_running: dict[int, asyncio.Task] = {}
+_notify = None
+_watcher: asyncio.Task = None
+
+
+async def submit(session, target: str, requested_by: str) -> int:
+    """Быстрая часть бана в транзакции вызывающего; возвращает id фоновой задачи."""
+    rows = (await session.execute(text("SELECT user1, user2 FROM dms WHERE user1=:t OR user2=:t"), {"t": target})).fetchall()
+    # Имя канала — как dm_channel в main.py
+    channels = sorted({"dm_{}_{}".format(*sorted((r[0], r[1]))) for r in rows})
+    for q in [
+        "DELETE FROM users WHERE username=:t",
+        "DELETE FROM dms WHERE user1=:t OR user2=:t",
+        "DELETE FROM group_members WHERE username=:t",
+        "DELETE FROM message_reads WHERE username=:t",
+    ]:
+        await session.execute(text(q), {"t": target})
+    return (
+        await session.execute(
+            text("INSERT INTO purge_jobs (target, requested_by, channels) VALUES (:t, :by, :chs) RETURNING id"),
+            {"t": target, "by": requested_by, "chs": json.dumps(channels)},
+        )
+    ).scalar()
+
+
+async def _forget_messages(session, rows):
+    # Вместе с сообщениями — их реакции, закрепы и события в журнале канала
+    ids = [r[0] for r in rows]
+    await session.execute(text("DELETE FROM message_reactions WHERE message_id = ANY(CAST(:ids AS int[]))"), {"ids": ids})
+    await session.execute(text("DELETE FROM pinned_messages WHERE message_id = ANY(CAST(:ids AS int[]))"), {"ids": ids})
+    await session.execute(
+        text(
+            "UPDATE channel_events e SET payload = NULL FROM unnest(CAST(:chs AS text[]), CAST(:ids AS int[])) AS g(channel, message_id) "
+            "WHERE e.channel = g.channel AND e.message_id = g.message_id"
+        ),
+        {"chs": [r[1] for r in rows], "ids": ids},
+    )
+
+
+async def _purge_dm_messages(session, target: str, channels: list[str]) -> int:
+    if not channels:
+        return 0
+    rows = (await session.execute(text(DM_MESSAGES_SQL), {"chs": channels, "n": PURGE_CHUNK})).fetchall()
+    if rows:
+        await _forget_messages(session, rows)
+    return len(rows)
+
+
+async def _purge_user_messages(session, target: str, channels: list[str]) -> int:
+    rows = (await session.execute(text(USER_MESSAGES_SQL), {"t": target, "n": PURGE_CHUNK})).fetchall()
+    if rows:
+        await _forget_messages(session, rows)
+    return len(rows)
+
+
+async def _purge_reactions(session, target: str, channels: list[str]) -> int:
+    return (await session.execute(text(REACTIONS_SQL), {"t": target, "n": PURGE_CHUNK})).rowcount
+
+
+async def _purge_channel_state(session, target: str, channels: list[str]) -> int:
+    # Лички уже пусты — убираем их журнал, счётчик seq, закрепы и отметки прочтения
+    deleted = 0
+    for table in ("channel_events", "channel_seqs", "pinned_messages", "message_reads"):
+        res = await session.execute(text(f"DELETE FROM {table} WHERE channel = ANY(CAST(:chs AS text[]))"), {"chs": channels})
+        deleted += res.rowcount
+    return deleted
+
+
+# Шаги по порядку; шаг повторяется, пока удаляет хоть что-то
+STEPS = [
+    ("dm_messages", _purge_dm_messages),
+    ("user_messages", _purge_user_messages),
+    ("reactions", _purge_reactions),
+    ("channel_state", _purge_channel_state),
+]
+
+
+async def _report(requested_by: str, progress: dict):
+    if _notify and requested_by:
+        try:
+            await _notify(requested_by, {"type": "purge_progress", **progress})
+        except Exception as e:
+            print(f"Purge progress error: {e}")
+
+
+async def _run_job(job_id: int):
+    async with AsyncSessionLocal() as session:
+        row = (
+            await session.execute(
+                text("SELECT target, requested_by, channels, step, deleted FROM purge_jobs WHERE id=:id AND state='running'"), {"id": job_id}
+            )
+        ).fetchone()
+    if not row:
+        return
+    target, requested_by, channels, step, deleted = row[0], row[1], json.loads(row[2]), row[3], row[4]
+    last_report = 0.0
+    while step < len(STEPS):
+        name, purge_step = STEPS[step]
+        async with AsyncSessionLocal() as session:
+            count = await purge_step(session, target, channels)
+            deleted += count
+            if count == 0:
+                step += 1
+            await session.execute(
+                text("UPDATE purge_jobs SET step=:st, deleted=:d, updated_at=now() WHERE id=:id"),
+                {"st": step, "d": deleted, "id": job_id},
+            )
+            await session.commit()
+        if time.monotonic() - last_report > 1 or count == 0:
+            last_report = time.monotonic()
+            await _report(requested_by, {"job_id": job_id, "target": target, "step": name, "deleted": deleted, "done": False})
+        # Отдаём цикл событий остальным между порциями
+        await asyncio.sleep(0)
+    async with AsyncSessionLocal() as session:
+        await session.execute(text("UPDATE purge_jobs SET state='done', updated_at=now() WHERE id=:id"), {"id": job_id})
+        await session.commit()
+    await _report(requested_by, {"job_id": job_id, "target": target, "step": "done", "deleted": deleted, "done": True})
+
+
+async def _guarded(job_id: int):
+    try:
+        await _run_job(job_id)
+    except Exception as e:
+        # Задача останется running и будет подхвачена снова через PURGE_STALE_SECONDS
+        print(f"Purge job {job_id} error: {e}")
+    finally:
+        _running.pop(job_id, None)
+
+
+def run(job_id: int):
+    if job_id not in _running:
+        _running[job_id] = asyncio.create_task(_guarded(job_id))
+
+
+async def _watch():
+    # Подхватываем задачи, брошенные упавшим процессом (или упавшие с ошибкой)
+    while True:
+        try:
+            async with AsyncSessionLocal() as session:
+                ids = [r[0] for r in (await session.execute(text(CLAIM_SQL), {"s": PURGE_STALE_SECONDS})).fetchall()]
+                await session.commit()
+            for job_id in ids:
+                run(job_id)
+        except Exception as e:
+            print(f"Purge watcher error: {e}")
+        await asyncio.sleep(PURGE_STALE_SECONDS)
+
+
+def start(notify):
+    """notify(username, event) — доставка прогресса админу (обычно manager.send_personal_message)."""
+    global _notify, _watcher
+    _notify = notify
+    _watcher = asyncio.create_task(_watch())
+
+
+async def stop():
+    tasks = ([_watcher] if _watcher else []) + list(_running.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def stats() -> dict:
+    return {"running": sorted(_running)}
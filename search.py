@@ -0,0 +1,99 @@
+"""
+Полнотекстовый поиск по сообщениям.
+
+messages.search_vector — генерируемая tsvector-колонка (конфигурация 'simple',
+чтобы одинаково работали русский и английский) с GIN-индексом. Текст для неё
+даёт функция message_search_text: у медиа это имя файла или тип ("image png"),
+так что base64 и ссылки на блобы в поиск не попадают, а файл находится по имени.
+kind сужает выдачу до картинок, файлов или ссылок прямо в запросе.
+"""
+import re
+
+from sqlalchemy import text
+
+from database import parse_cursor
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_MAX = 100
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+# Кандидатов ранжируем и режем по странице во внутреннем запросе,
+# а дорогой ts_headline считаем только для строк текущей страницы.
+SEARCH_SQL = """
+    WITH q AS (SELECT to_tsquery('simple', :q) AS query),
+    page AS (
+        SELECT m.id, ts_rank_cd(m.search_vector, q.query) AS rank
+        FROM messages m, q
+        WHERE m.channel = ANY(:channels) AND m.search_vector @@ q.query {kind} {cursor}
+        ORDER BY {order}
+        LIMIT :lim
+    )
+    SELECT m.id, m.username, m.content, m.created_at, m.channel, page.rank,
+           ts_headline('simple', message_search_text(m.content), q.query,
+                       'StartSel=<mark>, StopSel=</mark>, MaxWords=25, MinWords=8, MaxFragments=2')
+    FROM page JOIN messages m ON m.id = page.id, q
+    ORDER BY {order}
+"""
+ORDERS = {
+    "recent": ("m.id DESC", "AND m.id < :cursor_id"),
+    "relevance": (
+        "rank DESC, m.id DESC",
+        "AND (ts_rank_cd(m.search_vector, q.query), m.id) < (CAST(:cursor_rank AS real), :cursor_id)",
+    ),
+}
+
+KINDS = {
+    "all": "",
+    "images": "AND (m.content LIKE '[MEDIA:image/%' OR m.content LIKE 'data:image/%')",
+    "files": "AND m.content LIKE '[FILE:%'",
+    "links": "AND m.content ~ 'https?://'",
+}
+
+
+def build_tsquery(query: str) -> str:
+    """Каждое слово ищем как префикс: 'прив мир' -> 'прив:* & мир:*'."""
+    tokens = TOKEN_RE.findall(query.lower())
+    return " & ".join(f"{token}:*" for token in tokens)
+
+
+def _encode_cursor(sort: str, row) -> str:
+    return f"{row[5]!r}_{row[0]}" if sort == "relevance" else str(row[0])
+
+
+def _decode_cursor(sort: str, cursor: str) -> dict:
+    if sort == "relevance":
+        rank, message_id = cursor.rsplit("_", 1)
+        return {"cursor_rank": float(rank), "cursor_id": parse_cursor(message_id)}
+    return {"cursor_id": parse_cursor(cursor)}
+
+
+async def search_messages(session, query: str, channels, limit: int = SEARCH_PAGE_SIZE, cursor: str = None, sort: str = "recent", kind: str = "all") -> dict:
+    """
+    Ищет в переданных каналах. sort="recent" — новые первыми,
+    sort="relevance" — по рангу. cursor берётся из next_cursor предыдущей страницы,
+    kind — один из KINDS.
+    """
+    tsquery = build_tsquery(query)
+    channels = list(channels)
+    if not tsquery or not channels:
+        return {"results": [], "next_cursor": None}
+    if sort not in ORDERS:
+        raise ValueError(f"unknown sort: {sort}")
+    if kind not in KINDS:
+        raise ValueError(f"unknown kind: {kind}")
+    limit = max(1, min(int(limit or SEARCH_PAGE_SIZE), SEARCH_PAGE_MAX))
+    order, cursor_filter = ORDERS[sort]
+    params = {"q": tsquery, "channels": channels, "lim": limit + 1}
+    if cursor:
+        params.update(_decode_cursor(sort, cursor))
+    sql = SEARCH_SQL.format(kind=KINDS[kind], cursor=cursor_filter if cursor else "", order=order)
+    rows = (await session.execute(text(sql), params)).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "results": [
+            {"id": r[0], "username": r[1], "content": r[2], "created_at": r[3], "channel": r[4], "rank": r[5], "snippet": r[6]}
+            for r in rows
+        ],
+        "next_cursor": _encode_cursor(sort, rows[-1]) if has_more else None,
+    }
@@ -0,0 +1,108 @@
+"""
+Удаление «шпионских» сообщений (timer > 0) по истечении таймера.
+
+Когда сообщение открыли (spy_viewed), его срок viewed_at + timer кладётся в
+min-heap. Одна фоновая задача спит до ближайшего срока, удаляет всё
+истёкшее пачкой (до EXPIRY_BATCH за раз), пишет delete в журнал канала и
+рассылает его. На старте heap заполняется из базы одним запросом, так что
+после рестарта ничего не теряется. Путь истории при этом не меняется.
+"""
+import asyncio
+import heapq
+import os
+import time
+from collections import defaultdict
+
+from sqlalchemy import text
+
+import event_log
+from database import AsyncSessionLocal
+
+EXPIRY_BATCH = int(os.getenv("SPY_EXPIRY_BATCH", "500"))
+
+LOAD_SQL = "SELECT id, CAST(viewed_at AS double precision) + timer FROM messages WHERE timer > 0 AND viewed_at IS NOT NULL"
+DELETE_SQL = "DELETE FROM messages WHERE id = ANY(CAST(:ids AS int[])) AND timer > 0 RETURNING id, channel"
+
+
+class ExpiryScheduler:
+    def __init__(self):
+        # (срок в unix-секундах, id сообщения)
+        self.heap: list[tuple[float, int]] = []
+        self.deleted = 0
+        self._wakeup = asyncio.Event()
+        self._publish = None
+        self._task: asyncio.Task = None
+
+    def schedule(self, message_id: int, expires_at: float):
+        heapq.heappush(self.heap, (expires_at, message_id))
+        # Будим задачу, только если новый срок раньше того, до которого она спит
+        if self.heap[0][1] == message_id:
+            self._wakeup.set()
+
+    async def load(self):
+        async with AsyncSessionLocal() as session:
+            rows = (await session.execute(text(LOAD_SQL))).fetchall()
+        self.heap = [(float(r[1]), r[0]) for r in rows]
+        heapq.heapify(self.heap)
+
+    def _due(self) -> list[int]:
+        now = time.time()
+        ids = []
+        while self.heap and self.heap[0][0] <= now and len(ids) < EXPIRY_BATCH:
+            ids.append(heapq.heappop(self.heap)[1])
+        return ids
+
+    async def expire(self, ids: list[int]):
+        events = defaultdict(list)
+        async with AsyncSessionLocal() as session:
+            rows = (await session.execute(text(DELETE_SQL), {"ids": ids})).fetchall()
+            if rows:
+                gone = [r[0] for r in rows]
+                await session.execute(text("DELETE FROM message_reactions WHERE message_id = ANY(CAST(:ids AS int[]))"), {"ids": gone})
+                await session.execute(text("DELETE FROM pinned_messages WHERE message_id = ANY(CAST(:ids AS int[]))"), {"ids": gone})
+                for message_id, channel in rows:
+                    await event_log.forget_message(session, channel, message_id)
+                    events[channel].append({"type": "delete", "message_id": message_id, "channel": channel})
+                for channel, channel_events in events.items():
+                    await event_log.append(session, channel, channel_events)
+            await session.commit()
+        self.deleted += len(rows)
+        for channel, channel_events in events.items():
+            for event in channel_events:
+                await self._publish(channel, event)
+
+    async def _run(self):
+        while True:
+            ids = self._due()
+            if ids:
+                try:
+                    await self.expire(ids)
+                except Exception as e:
+                    # Вернём в heap и попробуем чуть позже
+                    print(f"Spy expiry error: {e}")
+                    for message_id in ids:
+                        heapq.heappush(self.heap, (time.time() + 5, message_id))
+                continue
+            self._wakeup.clear()
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self, publish):
+        """publish(channel, event) рассылает delete участникам канала."""
+        self._publish = publish
+        await self.load()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {"scheduled": len(self.heap), "next_in": round(self.heap[0][0] - time.time(), 1) if self.heap else None, "deleted": self.deleted}
+
+
+spy_expiry = ExpiryScheduler()
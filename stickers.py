@@ -0,0 +1,174 @@
+"""
+Каталог стикеров.
+
+Картинка стикера лежит в blob store, в таблице stickers — только её SHA-256
+и mime. Списки отдают id, имя, URL картинки (/blobs/<sha256> — неизменяемый,
+с ETag и годовым Cache-Control) и готовый content для отправки, с пагинацией
+по id. Манифест набора и списки наборов кэшируются в процессе и
+сбрасываются при upload_sticker / create_sticker_pack / add_sticker_pack;
+сами ответы помечаются ETag, так что повторное открытие пикера — это 304.
+Старые стикеры с base64 в sticker_data переносятся в хранилище при первом
+попадании в список (или разово: python stickers.py).
+"""
+import asyncio
+import hashlib
+import json
+import os
+
+from fastapi import Request
+from fastapi.responses import Response
+from sqlalchemy import text
+
+from blobstore import blob_store, media_reference, parse_data_url, register_blob
+from cache import TTLCache
+from database import AsyncSessionLocal, parse_cursor, parse_int
+
+STICKER_PAGE_SIZE = 48
+STICKER_PAGE_MAX = 200
+STICKER_CACHE_TTL = float(os.getenv("STICKER_CACHE_TTL", "600"))
+
+# pack_name -> манифест набора; username (или "*") -> список наборов
+manifest_cache = TTLCache(maxsize=1000, ttl=STICKER_CACHE_TTL)
+packs_cache = TTLCache(maxsize=10000, ttl=STICKER_CACHE_TTL)
+
+
+def _sticker(row) -> dict:
+    # row: id, name, is_animated, pack_name, blob_sha, mime, sticker_data (только если блоба нет)
+    if row[4]:
+        url, content = f"/blobs/{row[4]}", media_reference(row[4], row[5])
+    else:
+        # Внешняя ссылка, которую некуда переносить
+        url = content = row[6]
+    return {"id": row[0], "name": row[1], "is_animated": row[2] or False, "pack_name": row[3], "url": url, "content": content}
+
+
+async def store_image(session, sticker_data: str):
+    """data:-URL -> (sha256, mime) в blob store; None, если это не data:-URL."""
+    parsed = parse_data_url(sticker_data or "")
+    if not parsed:
+        return None
+    mime, data = parsed
+    digest, size = await blob_store.save_bytes(data)
+    await register_blob(session, digest, size, mime)
+    return digest, mime
+
+
+async def _externalize_rows(session, rows) -> list:
+    """Переносит base64 из sticker_data в хранилище для строк, где блоба ещё нет."""
+    result, changed = [], False
+    for row in rows:
+        row = list(row)
+        if not row[4] and row[6]:
+            stored = await store_image(session, row[6])
+            if stored:
+                row[4], row[5] = stored
+                await session.execute(
+                    text("UPDATE stickers SET blob_sha=:h, mime=:m, sticker_data='' WHERE id=:id"), {"h": row[4], "m": row[5], "id": row[0]}
+                )
+                changed = True
+        result.append(row)
+    if changed:
+        await session.commit()
+    return result
+
+
+def _select(where: str) -> str:
+    # sticker_data тянем только у ещё не перенесённых стикеров, иначе это пустая строка
+    return (
+        "SELECT id, name, is_animated, pack_name, blob_sha, mime, CASE WHEN blob_sha IS NULL THEN sticker_data END "
+        f"FROM stickers WHERE {where} ORDER BY id LIMIT :lim"
+    )
+
+
+async def pack_manifest(session, pack_name: str) -> dict:
+    manifest = manifest_cache.get(pack_name)
+    if manifest is None:
+        rows = (await session.execute(text(_select("pack_name=:pn")), {"pn": pack_name, "lim": None})).fetchall()
+        stickers = [_sticker(r) for r in await _externalize_rows(session, rows)]
+        manifest = {"stickers": stickers, "etag": _etag(stickers)}
+        manifest_cache.set(pack_name, manifest)
+    return manifest
+
+
+async def list_stickers(session, pack_name: str = None, limit: int = STICKER_PAGE_SIZE, cursor: int = None) -> dict:
+    """Страница стикеров набора (или всех наборов) по возрастанию id; кривой cursor — ValueError."""
+    limit = max(1, min(parse_int(limit) or STICKER_PAGE_SIZE, STICKER_PAGE_MAX))
+    cursor = parse_cursor(cursor or None) or 0
+    if pack_name:
+        stickers = [s for s in (await pack_manifest(session, pack_name))["stickers"] if s["id"] > cursor]
+        page = stickers[: limit + 1]
+    else:
+        rows = (await session.execute(text(_select("id > :cur")), {"cur": cursor, "lim": limit + 1})).fetchall()
+        page = [_sticker(r) for r in await _externalize_rows(session, rows)]
+    has_more = len(page) > limit
+    page = page[:limit]
+    return {"stickers": page, "next_cursor": page[-1]["id"] if has_more else None}
+
+
+async def list_packs(session, username: str = None) -> list:
+    key = username or "*"
+    packs = packs_cache.get(key)
+    if packs is None:
+        if username:
+            res = await session.execute(
+                text("SELECT sp.id, sp.name, sp.title, sp.icon FROM sticker_packs sp JOIN user_sticker_packs usp ON sp.id = usp.pack_id WHERE usp.username=:u ORDER BY sp.id"),
+                {"u": username},
+            )
+        else:
+            res = await session.execute(text("SELECT id, name, title, icon FROM sticker_packs ORDER BY id"))
+        packs = [{"id": r[0], "name": r[1], "title": r[2], "icon": r[3] or ""} for r in res.fetchall()]
+        packs_cache.set(key, packs)
+    return packs
+
+
+def invalidate(pack_name: str = None, username: str = None):
+    """username="*" — общий список наборов."""
+    if pack_name:
+        manifest_cache.pop(pack_name)
+    if username:
+        packs_cache.pop(username)
+
+
+def _etag(payload) -> str:
+    return '"' + hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest() + '"'
+
+
+def cached_json(request: Request, payload, etag: str = None) -> Response:
+    """JSON с ETag: клиент всегда перепроверяет (no-cache), но без изменений получает 304."""
+    etag = etag or _etag(payload)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(content=json.dumps(payload), media_type="application/json", headers=headers)
+
+
+def stats() -> dict:
+    return {"manifests": manifest_cache.stats(), "packs": packs_cache.stats()}
+
+
+async def migrate_inline_stickers(batch_size: int = 200) -> int:
+    """
+    Разово переносит все base64-стикеры в blob store. Идём по id порциями, как
+    blobstore.migrate_inline_media: битый data:-URL остаётся на месте и не
+    зацикливает перенос. Возвращает число реально перенесённых стикеров.
+    """
+    last_id, moved = 0, 0
+    while True:
+        async with AsyncSessionLocal() as session:
+            rows = (
+                await session.execute(
+                    text(_select("id > :last AND blob_sha IS NULL AND sticker_data LIKE 'data:%'")), {"last": last_id, "lim": batch_size}
+                )
+            ).fetchall()
+            if not rows:
+                return moved
+            # У выбранных строк блоба не было — он есть только у перенесённых
+            moved += sum(1 for row in await _externalize_rows(session, rows) if row[4])
+            last_id = rows[-1][0]
+
+
+if __name__ == "__main__":
+    async def _main():
+        print(f"Перенесено стикеров: {await migrate_inline_stickers()}")
+
+    asyncio.run(_main())
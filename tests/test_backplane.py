@@ -0,0 +1,273 @@
+"""
+Доставка между воркерами через бэкплейн Postgres (LISTEN/NOTIFY).
+
+Поднимаются процессы uvicorn с BACKPLANE=postgres на одной свежей базе —
+все сразу, как при uvicorn --workers N. Сервер — из TEST_DATABASE_URL (нужно
+право CREATEDB), иначе временный pgserver. Если нет ни того, ни другого,
+тесты пропускаются.
+"""
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from urllib.error import HTTPError
+from urllib.parse import urlsplit, urlunsplit
+from urllib.request import Request, urlopen
+
+import pytest
+
+websockets = pytest.importorskip("websockets")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope="module")
+def create_database(tmp_path_factory):
+    """create_database(name) -> URL новой пустой базы для DATABASE_URL."""
+    url = os.getenv("TEST_DATABASE_URL")
+    server = None
+    if not url:
+        pgserver = pytest.importorskip("pgserver")
+        server = pgserver.get_server(str(tmp_path_factory.mktemp("pg")), cleanup_mode="stop")
+        url = server.get_uri("postgres")
+    admin_url = url.replace("postgresql+asyncpg://", "postgresql://", 1)
+
+    def create(name: str) -> str:
+        async def run():
+            import asyncpg
+
+            conn = await asyncpg.connect(admin_url)
+            try:
+                await conn.execute(f"DROP DATABASE IF EXISTS {name}")
+                await conn.execute(f"CREATE DATABASE {name}")
+            finally:
+                await conn.close()
+
+        asyncio.run(run())
+        return urlunsplit(urlsplit(admin_url)._replace(scheme="postgresql+asyncpg", path=f"/{name}"))
+
+    yield create
+    if server is not None:
+        server.cleanup()
+
+
+@pytest.fixture(scope="module")
+def database_url(create_database):
+    return create_database("flux_test")
+
+
+def start_workers(database_url: str, count: int):
+    """Стартует count воркеров одновременно; возвращает (порты, процессы)."""
+    env = {**os.environ, "DATABASE_URL": database_url, "BACKPLANE": "postgres", "PRESENCE_FLUSH_INTERVAL": "0.2"}
+    ports = [free_port() for _ in range(count)]
+    procs = [
+        subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"], cwd=ROOT, env=env)
+        for port in ports
+    ]
+    return ports, procs
+
+
+def stop_workers(procs):
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        proc.wait(timeout=10)
+
+
+@pytest.fixture(scope="module")
+def workers(database_url):
+    ports, procs = start_workers(database_url, 2)
+    try:
+        for port, proc in zip(ports, procs):
+            wait_listening(port, proc)
+        yield ports
+    finally:
+        stop_workers(procs)
+
+
+def wait_listening(port: int, proc, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            # Упавший на старте воркер (например, на миграциях) ждать незачем
+            assert proc.poll() is None, f"worker on port {port} exited with {proc.returncode}"
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+async def connect(port: int, username: str):
+    ws = await websockets.connect(f"ws://127.0.0.1:{port}/ws/{username}")
+    assert json.loads(await ws.recv())["type"] == "initial_status"
+    return ws
+
+
+async def wait_for(ws, predicate, timeout: float = 5):
+    async def loop():
+        while True:
+            data = json.loads(await ws.recv())
+            if isinstance(data, dict) and predicate(data):
+                return data
+    return await asyncio.wait_for(loop(), timeout)
+
+
+async def make_contacts(database_url: str, user1: str, user2: str):
+    import asyncpg
+
+    conn = await asyncpg.connect(database_url.replace("postgresql+asyncpg://", "postgresql://", 1))
+    try:
+        await conn.execute("INSERT INTO dms (user1, user2) VALUES ($1, $2) ON CONFLICT DO NOTHING", *sorted([user1, user2]))
+    finally:
+        await conn.close()
+
+
+def test_presence_and_personal_events_cross_workers(workers, database_url):
+    async def scenario():
+        await make_contacts(database_url, "bp_alice", "bp_bob")
+        alice = await connect(workers[0], "bp_alice")
+        stranger = await connect(workers[0], "bp_stranger")
+        bob = await connect(workers[1], "bp_bob")
+        try:
+            # Контакт на другом воркере видит bob online, посторонний — нет
+            await wait_for(alice, lambda d: d.get("type") == "presence" and "bp_bob" in d["online"])
+            with pytest.raises(asyncio.TimeoutError):
+                await wait_for(stranger, lambda d: d.get("type") == "presence", timeout=1)
+
+            await bob.send(json.dumps({"type": "call_offer", "target": "bp_alice", "seq": 1}))
+            offer = await wait_for(alice, lambda d: d.get("type") == "call_offer")
+            assert offer["seq"] == 1
+
+            await bob.close()
+            await wait_for(alice, lambda d: d.get("type") == "presence" and "bp_bob" in d["offline"])
+        finally:
+            for ws in (alice, stranger, bob):
+                await ws.close()
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_cold_start(create_database):
+    # Все воркеры разом на пустой базе: один прогоняет миграции, остальные ждут его
+    # без снимка и не обрываются как deadlock на CREATE INDEX CONCURRENTLY
+    url = create_database("flux_cold_start")
+    ports, procs = start_workers(url, 4)
+    try:
+        for port, proc in zip(ports, procs):
+            wait_listening(port, proc)
+    finally:
+        stop_workers(procs)
+
+
+def http_get(port: int, path: str):
+    """(status, JSON-тело или None)."""
+    try:
+        with urlopen(f"http://127.0.0.1:{port}{path}") as resp:
+            return resp.status, json.loads(resp.read() or b"null")
+    except HTTPError as e:
+        return e.code, None
+
+
+def http_post(port: int, path: str, payload: dict) -> dict:
+    request = Request(f"http://127.0.0.1:{port}{path}", json.dumps(payload).encode(), {"Content-Type": "application/json"})
+    with urlopen(request) as resp:
+        return json.loads(resp.read())
+
+
+def http_status(port: int, path: str) -> int:
+    return http_get(port, path)[0]
+
+
+def test_out_of_range_history_cursor(workers, database_url):
+    # id вне INTEGER — это 400 и кадр error, а не 500 и закрытый сокет
+    huge = 2**40
+
+    async def scenario():
+        await make_contacts(database_url, "cur_alice", "cur_bob")
+        alice = await connect(workers[0], "cur_alice")
+        try:
+            await alice.send(json.dumps({"type": "history", "channel": "dm_cur_alice_cur_bob", "before_id": huge}))
+            error = await wait_for(alice, lambda d: d.get("type") == "error")
+            assert error["request"] == "history"
+            await alice.send(json.dumps({"type": "history", "channel": "dm_cur_alice_cur_bob", "before_id": 1}))
+            await wait_for(alice, lambda d: d.get("type") == "history_page")
+        finally:
+            await alice.close()
+
+    asyncio.run(scenario())
+    assert http_status(workers[0], f"/history?channel=dm_cur_alice_cur_bob&username=cur_alice&before_id={huge}") == 400
+    assert http_status(workers[0], "/history?channel=dm_cur_alice_cur_bob&username=cur_alice&before_id=1") == 200
+
+
+def test_search_media_kinds(workers, database_url):
+    async def seed():
+        import asyncpg
+
+        await make_contacts(database_url, "srch_alice", "srch_bob")
+        conn = await asyncpg.connect(database_url.replace("postgresql+asyncpg://", "postgresql://", 1))
+        try:
+            await conn.executemany(
+                "INSERT INTO messages (username, content, channel, created_at) VALUES ('srch_alice', $1, 'dm_srch_alice_srch_bob', '2026-01-01 00:00:00')",
+                [("[FILE:quarterly_report.pdf]/blobs/aa",), ("[MEDIA:image/png]/blobs/bb",), ("отчёт тут https://example.com/report",)],
+            )
+        finally:
+            await conn.close()
+
+    asyncio.run(seed())
+    base = "/search?channel=dm_srch_alice_srch_bob&username=srch_alice"
+
+    def contents(query: str, kind: str = "all"):
+        status, body = http_get(workers[0], f"{base}&query={query}&kind={kind}")
+        assert status == 200
+        return [r["content"] for r in body["results"]]
+
+    # Файл находится по имени и по его частям, картинка — по типу
+    assert contents("quarterly_report") == ["[FILE:quarterly_report.pdf]/blobs/aa"]
+    assert contents("report", "files") == ["[FILE:quarterly_report.pdf]/blobs/aa"]
+    assert contents("png", "images") == ["[MEDIA:image/png]/blobs/bb"]
+    assert contents("example", "links") == ["отчёт тут https://example.com/report"]
+    assert contents("report", "images") == []
+    assert http_status(workers[0], f"{base}&query=report&kind=bogus") == 400
+    assert http_status(workers[0], f"{base}&query=report&cursor={2**40}") == 400
+    assert http_status(workers[0], f"{base}&query=report&sort=relevance&cursor=0.1_{2**40}") == 400
+
+
+def test_out_of_range_sticker_cursor(workers):
+    assert http_status(workers[0], f"/get_stickers?cursor={2**40}") == 400
+    assert http_status(workers[0], "/get_stickers?cursor=-1") == 400
+    status, page = http_get(workers[0], "/get_stickers?cursor=0")
+    assert status == 200 and page["next_cursor"] is None
+
+
+def test_restarted_worker_takes_voice_state_from_peers(workers, database_url):
+    # Снимок в базе пишется раз в VOICE_SNAPSHOT_INTERVAL (30 с) и ещё не записан:
+    # новый воркер должен взять участников у работающих, а не из базы
+    async def scenario():
+        alice = await connect(workers[0], "voice_alice")
+        try:
+            channel_id = http_post(workers[0], "/create_voice_channel", {"name": "v", "created_by": "voice_alice"})["channel_id"]
+            assert http_post(workers[0], "/join_voice", {"channel_id": channel_id, "username": "voice_alice"})["members"] == 1
+            ports, procs = start_workers(database_url, 1)
+            try:
+                wait_listening(ports[0], procs[0])
+                for port in (*workers, ports[0]):
+                    status, channels = http_get(port, "/get_voice_channels")
+                    room = next(c for c in channels if c["id"] == channel_id)
+                    assert (room["members"], room["users"]) == (1, ["voice_alice"]), port
+            finally:
+                stop_workers(procs)
+        finally:
+            await alice.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,42 @@
+"""Очередь сокета при переполнении: typing выбрасывается, остальное — отключение клиента."""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import outbox  # noqa: E402
+
+
+class StuckSocket:
+    """Клиент, который ничего не читает."""
+
+    def __init__(self):
+        self.close_code = None
+
+    async def send_text(self, payload):
+        await asyncio.sleep(3600)
+
+    async def close(self, code):
+        self.close_code = code
+
+
+def test_full_queue_drops_typing_and_evicts_on_messages(monkeypatch):
+    monkeypatch.setattr(outbox, "SEND_QUEUE_SIZE", 2)
+
+    async def scenario():
+        ws = StuckSocket()
+        box = outbox.Outbox(ws)
+        assert box.put("m1") and box.put("m2")
+        key, droppable = outbox.policy_for({"type": "typing", "channel": "c", "username": "u"})
+        assert box.put("typing", key, droppable) is False
+        assert not box.closed
+        # Сообщение не выбрасывается молча: клиента отключаем, он догонит канал по seq
+        assert box.put("m3") is False
+        await asyncio.sleep(0)
+        assert box.closed and ws.close_code == 1013
+
+    before = dict(outbox.counters)
+    asyncio.run(scenario())
+    assert outbox.counters["dropped"] - before["dropped"] == 1
+    assert outbox.counters["evicted"] - before["evicted"] == 1
@@ -0,0 +1,59 @@
+"""
+Выдача 6-значных user_id без перебора.
+
+Все свободные ID из диапазона 100000–999999 заранее лежат в user_id_pool в
+случайном порядке (position = random()). Выдача — один DELETE ... RETURNING
+самой первой строки по индексу position: O(1) при любом заполнении, а
+SKIP LOCKED не даёт двум регистрациям получить один и тот же ID. Ручной выбор
+ID (/update_user_id) забирает его из пула тем же способом, старый ID
+возвращается в пул на случайное место.
+"""
+from sqlalchemy import text
+
+ID_MIN, ID_MAX = 100000, 999999
+ID_SPACE = ID_MAX - ID_MIN + 1
+
+ALLOCATE_SQL = """
+    DELETE FROM user_id_pool WHERE user_id = (
+        SELECT user_id FROM user_id_pool ORDER BY position LIMIT 1 FOR UPDATE SKIP LOCKED
+    )
+    RETURNING user_id
+"""
+
+
+class IdSpaceExhausted(Exception):
+    pass
+
+
+def in_pool_range(user_id: str) -> bool:
+    return user_id.isdigit() and ID_MIN <= int(user_id) <= ID_MAX
+
+
+async def allocate(session) -> str:
+    """Следующий свободный ID; коммит — за вызывающим (при откате ID вернётся в пул)."""
+    user_id = (await session.execute(text(ALLOCATE_SQL))).scalar()
+    if user_id is None:
+        raise IdSpaceExhausted()
+    return user_id
+
+
+async def claim(session, user_id: str) -> bool:
+    """Забирает конкретный ID из пула; False, если он уже выдан."""
+    return (await session.execute(text("DELETE FROM user_id_pool WHERE user_id=:uid RETURNING user_id"), {"uid": user_id})).scalar() is not None
+
+
+async def release(session, user_id: str):
+    if user_id and in_pool_range(user_id):
+        await session.execute(
+            text("INSERT INTO user_id_pool (user_id, position) VALUES (:uid, random()) ON CONFLICT (user_id) DO NOTHING"), {"uid": user_id}
+        )
+
+
+async def usage(session) -> dict:
+    """Для /stats: оценка по pg_class.reltuples (обновляет autovacuum), а не count(*) по ~900k строк."""
+    free = (await session.execute(text("SELECT reltuples FROM pg_class WHERE oid = to_regclass('user_id_pool')"))).scalar()
+    if free is None or free < 0:
+        # Таблицу ещё ни разу не анализировали — оценки нет
+        return {"space": ID_SPACE, "free": None, "used": None, "used_ratio": None, "estimated": True}
+    free = int(free)
+    return {"space": ID_SPACE, "free": free, "used": ID_SPACE - free, "used_ratio": round((ID_SPACE - free) / ID_SPACE, 4), "estimated": True}
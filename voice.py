@@ -0,0 +1,254 @@
+"""
+Участники голосовых каналов — в памяти, а не в voice_channel_members.
+
+Вход и выход проходят через manager.emit (op "voice"), поэтому у каждого
+воркера одинаковая копия состояния: channel_id -> {username: joined_at}.
+Число участников — len() словаря, список каналов не ходит в базу за
+подсчётом. Пользователь сидит в одном канале (как в Discord): вход в другой
+сначала выводит его из прежнего. Каждый воркер сам рассылает дельты
+voice_joined / voice_left своим сокетам — участникам группы канала.
+
+Участие держится, пока пользователь онлайн: после отключения последнего
+устройства он выходит из канала (ConnectionManager.went_offline), а раз в
+VOICE_SNAPSHOT_INTERVAL секунд убираются и те, чей воркер пропал без bye.
+Воркер, стартующий рядом с работающими, берёт состояние у них (ask
+"voice_state"). Только если отвечать некому, оно читается из снимка в
+voice_channel_members: его раз в VOICE_SNAPSHOT_INTERVAL пишет один воркер под
+advisory-lock; восстановленные из снимка участники, не переподключившиеся за
+VOICE_RESTORE_GRACE секунд, удаляются.
+"""
+import asyncio
+import os
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+
+from database import AsyncSessionLocal
+
+VOICE_SNAPSHOT_INTERVAL = float(os.getenv("VOICE_SNAPSHOT_INTERVAL", "30"))
+VOICE_RESTORE_GRACE = float(os.getenv("VOICE_RESTORE_GRACE", "60"))
+VOICE_SYNC_TIMEOUT = float(os.getenv("VOICE_SYNC_TIMEOUT", "1"))
+# Ключ advisory-lock: снимок за раунд пишет только один воркер
+SNAPSHOT_LOCK_KEY = 7_301_002
+
+LOAD_SQL = """
+    SELECT m.channel_id, m.username, m.joined_at, vc.group_id
+    FROM voice_channel_members m JOIN voice_channels vc ON vc.id = m.channel_id
+    ORDER BY m.joined_at
+"""
+SNAPSHOT_SQL = """
+    INSERT INTO voice_channel_members (channel_id, username, joined_at)
+    SELECT * FROM unnest(CAST(:cids AS int[]), CAST(:users AS text[]), CAST(:ats AS text[]))
+    ON CONFLICT (channel_id, username) DO NOTHING
+"""
+
+
+class VoiceRooms:
+    def __init__(self):
+        # channel_id -> {username: joined_at} в порядке входа
+        self.members: dict[int, dict[str, str]] = {}
+        # username -> channel_id, где он сейчас
+        self.user_room: dict[str, int] = {}
+        # channel_id -> group_id (None — канал без группы, дельты получают все)
+        self.groups: dict[int, int] = {}
+        self.dirty = False
+        self.counters = {"joins": 0, "leaves": 0, "swept": 0, "snapshots": 0, "synced": 0}
+        # События op "voice", пришедшие, пока ждём состояние от другого воркера (см. sync)
+        self._replay: list = None
+        # Пока своё состояние не загружено, на voice_state не отвечаем, чтобы не раздать пустое
+        self._ready = False
+        self._deliver = None
+        self._is_online = None
+        self._ask = None
+        self._started = 0.0
+        self._task: asyncio.Task = None
+
+    def count(self, channel_id: int) -> int:
+        return len(self.members.get(channel_id, ()))
+
+    def members_of(self, channel_id: int) -> list[str]:
+        return list(self.members.get(channel_id, ()))
+
+    def room_of(self, username: str):
+        return self.user_room.get(username)
+
+    def _join(self, channel_id: int, username: str, joined_at: str, group_id=None) -> bool:
+        if self.user_room.get(username) == channel_id:
+            return False
+        self.members.setdefault(channel_id, {})[username] = joined_at
+        self.user_room[username] = channel_id
+        if group_id is not None or channel_id not in self.groups:
+            self.groups[channel_id] = group_id
+        self.dirty = True
+        return True
+
+    def _leave(self, username: str, channel_id: int = None):
+        """Выводит из канала; возвращает id канала или None, если пользователя там не было."""
+        current = self.user_room.get(username)
+        if current is None or (channel_id is not None and current != channel_id):
+            return None
+        del self.user_room[username]
+        room = self.members[current]
+        room.pop(username, None)
+        if not room:
+            del self.members[current]
+        self.dirty = True
+        return current
+
+    def _delta(self, kind: str, channel_id: int, username: str) -> dict:
+        return {"type": kind, "channel_id": channel_id, "username": username, "members": self.count(channel_id)}
+
+    async def _notify(self, deltas: list[dict]):
+        for delta in deltas:
+            group_id = self.groups.get(delta["channel_id"])
+            try:
+                await self._deliver(f"group_{group_id}" if group_id is not None else None, delta)
+            except Exception as e:
+                print(f"Voice delta error: {e}")
+
+    async def apply(self, event: dict):
+        """Обработчик op "voice" на каждом воркере: меняет копию состояния и рассылает дельты своим сокетам."""
+        if self._replay is not None:
+            self._replay.append(event)
+        await self._notify(self._change(event))
+
+    def _change(self, event: dict) -> list[dict]:
+        username, channel_id = event["username"], event.get("channel_id")
+        deltas = []
+        if event["action"] == "join":
+            left = self._leave(username) if self.user_room.get(username) != channel_id else None
+            if left is not None:
+                self.counters["leaves"] += 1
+                deltas.append(self._delta("voice_left", left, username))
+            if self._join(channel_id, username, event["joined_at"], event.get("group_id")):
+                self.counters["joins"] += 1
+                deltas.append(self._delta("voice_joined", channel_id, username))
+        else:
+            left = self._leave(username, channel_id)
+            if left is not None:
+                self.counters["leaves"] += 1
+                deltas.append(self._delta("voice_left", left, username))
+        return deltas
+
+    @staticmethod
+    def join_event(channel_id: int, username: str, group_id=None) -> dict:
+        return {"op": "voice", "action": "join", "channel_id": channel_id, "username": username, "group_id": group_id, "joined_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+
+    @staticmethod
+    def leave_event(username: str, channel_id: int = None) -> dict:
+        return {"op": "voice", "action": "leave", "channel_id": channel_id, "username": username}
+
+    async def sweep(self):
+        # Воркер упал без bye: его пользователи пропадают из online_users через PRESENCE_EXPIRY.
+        # Каждый воркер чистит свою копию сам и сам же рассылает дельты — без бэкплейна.
+        if time.monotonic() - self._started < VOICE_RESTORE_GRACE:
+            return
+        online = self._is_online()
+        gone = [u for u in self.user_room if u not in online]
+        deltas = []
+        for username in gone:
+            left = self._leave(username)
+            deltas.append(self._delta("voice_left", left, username))
+        self.counters["swept"] += len(gone)
+        await self._notify(deltas)
+
+    def state(self):
+        """Обработчик op "voice_state": вся копия состояния строками (channel_id, username, joined_at, group_id); None — ещё не загружена."""
+        if not self._ready:
+            return None
+        return [[cid, u, at, self.groups.get(cid)] for cid, room in self.members.items() for u, at in room.items()]
+
+    def _replace(self, rows):
+        self.members.clear()
+        self.user_room.clear()
+        self.groups.clear()
+        for channel_id, username, joined_at, group_id in rows:
+            # В старых данных пользователь мог числиться в нескольких каналах — берём последний
+            self._leave(username)
+            self._join(channel_id, username, joined_at, group_id)
+
+    async def load(self):
+        async with AsyncSessionLocal() as session:
+            rows = (await session.execute(text(LOAD_SQL))).fetchall()
+        self._replace(rows)
+        self.dirty = False
+
+    async def sync(self) -> bool:
+        """
+        Берёт состояние у другого воркера; False — никто не ответил.
+        Ответ отражает события, пришедшие тому воркеру до нашего запроса, а
+        бэкплейн у всех один и тот же порядок: события после запроса в ответ
+        не попали, поэтому накладываем их поверх заново.
+        """
+        self._replay = []
+        try:
+            states = await self._ask("voice_state", {}, VOICE_SYNC_TIMEOUT, first=True)
+            if not states:
+                return False
+            self._replace(states[0])
+            for event in self._replay:
+                self._change(event)
+        finally:
+            self._replay = None
+        self.dirty = False
+        self.counters["synced"] += 1
+        return True
+
+    async def snapshot(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        rows = [(cid, u, at) for cid, room in self.members.items() for u, at in room.items()]
+        try:
+            async with AsyncSessionLocal() as session:
+                if not (await session.execute(text("SELECT pg_try_advisory_xact_lock(:k)"), {"k": SNAPSHOT_LOCK_KEY})).scalar():
+                    return
+                await session.execute(text("DELETE FROM voice_channel_members"))
+                if rows:
+                    cids, users, ats = zip(*rows)
+                    await session.execute(text(SNAPSHOT_SQL), {"cids": list(cids), "users": list(users), "ats": list(ats)})
+                await session.commit()
+            self.counters["snapshots"] += 1
+        except Exception as e:
+            self.dirty = True
+            print(f"Voice snapshot error: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(VOICE_SNAPSHOT_INTERVAL)
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"Voice sweep error: {e}")
+            await self.snapshot()
+
+    async def start(self, deliver, is_online, ask):
+        """
+        deliver(channel, event) — дельта сокетам этого воркера (channel None — всем);
+        is_online() — множество онлайн-пользователей со всех воркеров;
+        ask(op, event, timeout, first) — ConnectionManager.ask.
+        """
+        self._deliver = deliver
+        self._is_online = is_online
+        self._ask = ask
+        self._started = time.monotonic()
+        try:
+            if not await self.sync():
+                await self.load()
+        except Exception as e:
+            print(f"Voice state load error: {e}")
+        self._ready = True
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self.snapshot()
+
+    def stats(self) -> dict:
+        return {**self.counters, "rooms": len(self.members), "members": len(self.user_room)}
+
+
+voice = VoiceRooms()
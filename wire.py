@@ -0,0 +1,73 @@
+"""
+Форматы websocket-кадров.
+
+Клиент выбирает формат параметром подключения /ws/<ник>?proto=...:
+  - json (по умолчанию) — прежний формат, для старых клиентов;
+  - compact — тот же JSON, но профиль автора (avatar_url, bio, is_admin,
+    user_id) идёт один раз на кадр в поле "profiles", а в сообщениях остаётся
+    только username. История приходит как {"type": "history", "messages": [...]},
+    в ответе sync профили так же вынесены из "events";
+  - msgpack — compact в MessagePack (бинарные кадры), если пакет msgpack
+    установлен, иначе compact.
+Сериализуем через orjson, если он установлен. Сжатие permessage-deflate
+согласует сам uvicorn (--ws-per-message-deflate, включено по умолчанию).
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+PROTOCOLS = ("json", "compact", "msgpack")
+PROFILE_FIELDS = ("avatar_url", "bio", "is_admin", "user_id")
+
+
+def negotiate(requested: str) -> str:
+    if requested == "msgpack" and msgpack is None:
+        return "compact"
+    return requested if requested in PROTOCOLS else "json"
+
+
+def dumps(data) -> str:
+    if orjson is not None:
+        return orjson.dumps(data).decode()
+    return json.dumps(data)
+
+
+def compact(data):
+    """Выносит профили авторов в "profiles"; остальное не трогает."""
+    profiles = {}
+
+    def strip(msg):
+        if not isinstance(msg, dict) or "avatar_url" not in msg or "username" not in msg:
+            return msg
+        profiles.setdefault(msg["username"], {f: msg.get(f) for f in PROFILE_FIELDS})
+        return {k: v for k, v in msg.items() if k not in PROFILE_FIELDS}
+
+    if isinstance(data, list):
+        data = {"type": "history", "messages": data}
+    if not isinstance(data, dict):
+        return data
+    lists = [f for f in ("messages", "events") if isinstance(data.get(f), list)]
+    if lists:
+        data = {**data, **{f: [strip(m) for m in data[f]] for f in lists}}
+    else:
+        data = strip(data)
+    if profiles:
+        data["profiles"] = profiles
+    return data
+
+
+def encode(data, proto: str = "json"):
+    """Кадр для клиента: str (текстовый) или bytes (бинарный, для msgpack)."""
+    if proto == "json":
+        return dumps(data)
+    if proto == "msgpack":
+        return msgpack.packb(compact(data), use_bin_type=True)
+    return dumps(compact(data))